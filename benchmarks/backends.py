@@ -0,0 +1,77 @@
+"""Compare the inference backends against Keras on the shipped models.
+
+Run from the repository root:
+
+    python -m benchmarks.backends --n 2000 --batch-sizes 1 32 256
+
+Every model runs the same synthetic peptides through Keras predict, a
+traced tf.function and TFLite with and without int8 weight quantization.
+Outputs are compared to Keras and the best time per batch size is
+reported. Converted TFLite models are cached next to the model files,
+so this also prepares them ahead of deployment.
+
+"""
+import argparse
+import time
+import numpy as np
+from deeppep.config import get_model_info
+from deeppep.manager import PipelineManager
+from deeppep.prediction import PredictionManager
+from deeppep.types import Backend
+from .suite import synthetic_peptides, best_of
+
+VARIANTS = (("keras", Backend.keras, False),
+            ("function", Backend.function, False),
+            ("tflite", Backend.tflite, False),
+            ("tflite-int8", Backend.tflite, True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n", type=int, default=2000)
+    parser.add_argument("--batch-sizes", type=int, nargs="*", default=[1, 32, 256])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--models", nargs="*", default=None)
+    args = parser.parse_args()
+
+    header = "{:<18} {:<12} {:>9} {:>10} {:>9}".format(
+        "model", "backend", "load s", "max diff", "mean diff")
+    header += "".join(" {:>10}".format("b{} ms".format(size))
+                      for size in args.batch_sizes)
+    print(header)
+
+    for model_name in sorted(get_model_info()):
+        if args.models and model_name not in args.models:
+            continue
+
+        pipeline = PipelineManager(model_name)
+        spec = pipeline.model_config
+        encoded = pipeline.preprocessor().preprocess(
+            synthetic_peptides(args.n, pipeline.pre_config.vocab)
+        )
+
+        reference = None
+        for label, backend, quantize in VARIANTS:
+            start = time.perf_counter()
+            manager = PredictionManager(model_name, spec.config_path, spec.weight_path,
+                                        backend=backend, quantize=quantize,
+                                        seq_len=pipeline.pre_config.seq_len)
+            load_time = time.perf_counter() - start
+
+            output = manager._predict(encoded)
+            if reference is None:
+                reference = output
+            diff = np.abs(output - reference)
+
+            row = "{:<18} {:<12} {:9.2f} {:10.2e} {:9.2e}".format(
+                model_name, label, load_time, diff.max(), diff.mean())
+            for size in args.batch_sizes:
+                batch = encoded[:size]
+                manager._predict(batch)
+                row += " {:10.2f}".format(
+                    best_of(lambda: manager._predict(batch), args.repeat) * 1000)
+            print(row, flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Compare padded and length bucketed inference on the shipped models.
+
+Run from the repository root:
+
+    python -m benchmarks.bucketing --n 20000 --width 8
+
+"""
+import argparse
+import time
+import numpy as np
+from deeppep.config import get_model_info
+from deeppep.types import PreprocessingConfig, merge_configs
+from deeppep.preprocessing import PreprocessingManager
+from deeppep.prediction import PredictionManager
+from .encoder import random_peptides
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n", type=int, default=20000)
+    parser.add_argument("--width", type=int, default=8)
+    parser.add_argument("--models", nargs="*", default=None)
+    args = parser.parse_args()
+
+    sequences = random_peptides(args.n)
+    for model_name, spec in sorted(get_model_info().items()):
+        if args.models and model_name not in args.models:
+            continue
+
+        pre_config = merge_configs(PreprocessingConfig(), spec.pre_config)
+        encoded = PreprocessingManager(**pre_config.dict()).preprocess(sequences)
+        manager = PredictionManager(model_name, spec.config_path, spec.weight_path)
+
+        # Warm both paths so tracing is not part of the measurement
+        manager.model.predict(encoded[:256])
+        manager._predict_bucketed(encoded[:256], args.width)
+
+        padded_time, padded = timed(lambda: manager.model.predict(encoded))
+        bucketed_time, bucketed = timed(
+            lambda: manager._predict_bucketed(encoded, args.width)
+        )
+
+        print("{:<18} padded {:7.3f}s  bucketed {:7.3f}s  speedup {:4.1f}x"
+              "  max abs diff {:.2e}".format(
+                  model_name, padded_time, bucketed_time,
+                  padded_time / bucketed_time,
+                  np.abs(padded - bucketed).max()
+              ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Compare the single pass SequenceEncoder against the original per token loop.
+
+Run from the repository root:
+
+    python -m benchmarks.encoder --n 100000
+
+"""
+import argparse
+import random
+import re
+import time
+import numpy as np
+from itertools import chain
+from deeppep.types import DEFAULT_VOCAB
+from deeppep.preprocessing.encoder import SequenceEncoder
+
+PATTERN = "[A-Zn][^A-Zn]*"
+RESIDUES = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def random_peptides(n, min_len=7, max_len=30, seed=0):
+    rng = random.Random(seed)
+    peptides = []
+    for _ in range(n):
+        tokens = [rng.choice(RESIDUES) for _ in range(rng.randint(min_len, max_len))]
+        tokens = ["M[16]" if tok == "M" and rng.random() < .3 else tok
+                  for tok in tokens]
+        peptides.append("".join(tokens))
+
+    return peptides
+
+
+def legacy_encoding(sequences, vocab, seq_len):
+    # Consistency check followed by the nested loop encoder, as preprocessing ran before
+    oov_set = set(chain.from_iterable(
+        [re.findall(PATTERN, seq) for seq in sequences]
+        ))
+    oov_set.difference_update(vocab.keys())
+
+    regex = re.compile(PATTERN)
+    sequences = np.atleast_1d(sequences)
+    out = np.zeros(shape=(sequences.shape[0], seq_len), dtype=np.int32)
+    for seq_ind, seq in enumerate(sequences):
+        for match_ind, match in enumerate(regex.findall(seq)):
+            if match_ind == seq_len:
+                break
+
+            try:
+               out[seq_ind, match_ind] = vocab[match]
+            except KeyError:
+                pass
+
+    return out
+
+
+def best_of(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n", type=int, default=100000)
+    parser.add_argument("--seq-len", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    sequences = random_peptides(args.n)
+    encoder = SequenceEncoder(PATTERN, dict(DEFAULT_VOCAB), seq_len=args.seq_len)
+
+    legacy_time, legacy = best_of(
+        lambda: legacy_encoding(sequences, DEFAULT_VOCAB, args.seq_len),
+        args.repeat
+    )
+    new_time, (new, _) = best_of(lambda: encoder.transform_with_oov(sequences),
+                                 args.repeat)
+
+    assert new.dtype == legacy.dtype and np.array_equal(new, legacy)
+    print("peptides: {}".format(args.n))
+    print("legacy:   {:.3f}s".format(legacy_time))
+    print("encoder:  {:.3f}s".format(new_time))
+    print("speedup:  {:.1f}x".format(legacy_time / new_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Measure memory per gunicorn worker with and without preload_app.
+
+Run from the repository root on Linux:
+
+    python -m benchmarks.rss --workers 4
+
+Each mode starts the server through server_config.py with every model
+warmed up, waits for all workers to finish warming, then reads
+/proc/<pid>/smaps_rollup. RSS counts shared pages in full for every
+process, PSS splits them between the processes sharing them, and USS is
+memory private to one process, i.e. what each extra worker costs.
+
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+FIELDS = ("Rss", "Pss", "Private_Clean", "Private_Dirty")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def memory_mb(pid):
+    usage = dict.fromkeys(FIELDS, 0)
+    with open("/proc/{}/smaps_rollup".format(pid)) as handle:
+        for line in handle:
+            name, _, value = line.partition(":")
+            if name in usage:
+                usage[name] = int(value.split()[0]) / 1024
+
+    return {"rss" : usage["Rss"],
+            "pss" : usage["Pss"],
+            "uss" : usage["Private_Clean"] + usage["Private_Dirty"]}
+
+
+def children(pid):
+    with open("/proc/{0}/task/{0}/children".format(pid)) as handle:
+        return [int(child) for child in handle.read().split()]
+
+
+def measure(workers, preload, timeout):
+    env = dict(os.environ,
+               DEEPPEP_NWORKERS=str(workers),
+               DEEPPEP_PORT=str(free_port()),
+               DEEPPEP_PRELOAD_MODELS="*",
+               DEEPPEP_PRELOAD_APP="1" if preload else "0",
+               DEEPPEP_MAX_ACTIVE_JOBS="0")
+
+    with tempfile.TemporaryFile("w+") as log:
+        server = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn",
+             "--config", "./server_config.py", "deeppep:app"],
+            env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                log.seek(0)
+                if log.read().count("Warm up finished") >= workers:
+                    break
+                if server.poll() is not None or time.monotonic() > deadline:
+                    log.seek(0)
+                    raise SystemExit("Server did not warm up:\n" + log.read())
+                time.sleep(.5)
+
+            master = memory_mb(server.pid)
+            usage = [memory_mb(pid) for pid in children(server.pid)]
+
+        finally:
+            server.terminate()
+            server.wait()
+
+    return master, usage
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    row = "{:<10} {:<8} {:>9} {:>9} {:>9}"
+    print(row.format("mode", "process", "RSS MB", "PSS MB", "USS MB"))
+    for preload in (False, True):
+        mode = "preload" if preload else "default"
+        master, usage = measure(args.workers, preload, args.timeout)
+        print(row.format(mode, "master", *("{:.0f}".format(master[key])
+                                            for key in ("rss", "pss", "uss"))))
+        for ind, worker in enumerate(usage):
+            print(row.format(mode, "worker {}".format(ind),
+                             *("{:.0f}".format(worker[key])
+                               for key in ("rss", "pss", "uss"))))
+
+        total = master["pss"] + sum(worker["pss"] for worker in usage)
+        print(row.format(mode, "total", "", "{:.0f}".format(total), ""))
+
+
+if __name__ == "__main__":
+    main()
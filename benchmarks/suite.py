@@ -0,0 +1,413 @@
+"""Benchmark the serving path and compare the results against earlier runs.
+
+Run from the repository root:
+
+    python -m benchmarks.suite --output bench.json
+    python -m benchmarks.suite --output new.json --baseline bench.json
+
+Peptides are generated from each model's vocabulary, including modified
+tokens such as M[16], S[80] and n[42], with a fixed seed so that runs
+see the same inputs. The suite times tokenization, the out of vocabulary
+check, predict and encode for every shipped model over several batch
+sizes, output building, and whole requests sent to the app in process
+at several concurrency levels.
+
+Results are written as JSON. With --baseline each result is compared to
+the same case in an earlier run using the tolerances in thresholds.json,
+and the exit status is 1 if any case regressed.
+
+"""
+import argparse
+import asyncio
+import fnmatch
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import numpy as np
+
+PATTERN = "[A-Zn][^A-Zn]*"
+THRESHOLDS = os.path.join(os.path.dirname(__file__), "thresholds.json")
+
+
+###########
+# Inputs  #
+###########
+
+def synthetic_peptides(n, vocab, min_len=7, max_len=30, mod_rate=.15,
+                       nterm_rate=.1, seed=0):
+    """Tryptic looking peptides drawn from the tokens of a vocabulary.
+
+    Residues with a modified form in the vocabulary, e.g. S and S[80], take
+    it at `mod_rate`, and n[42] starts a peptide at `nterm_rate` if known.
+    """
+    rng = random.Random(seed)
+    residues = sorted(token for token in vocab if len(token) == 1 and token != "X")
+    modified = {}
+    for token in vocab:
+        if len(token) > 1 and token[0] in residues:
+            modified.setdefault(token[0], []).append(token)
+    cleavage = [token for token in ("K", "R") if token in residues] or residues
+
+    peptides = []
+    for _ in range(n):
+        tokens = [rng.choice(residues) for _ in range(rng.randint(min_len, max_len) - 1)]
+        tokens.append(rng.choice(cleavage))
+        tokens = [rng.choice(modified[tok])
+                  if tok in modified and rng.random() < mod_rate else tok
+                  for tok in tokens]
+        if "n[42]" in vocab and rng.random() < nterm_rate:
+            tokens.insert(0, "n[42]")
+        peptides.append("".join(tokens))
+
+    return peptides
+
+def model_vocab(model_name):
+    from deeppep.manager import PipelineManager
+    return PipelineManager(model_name).pre_config.vocab
+
+
+###########
+# Timing  #
+###########
+
+def best_of(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+def _result(seconds, rows, **params):
+    return dict(params, seconds=seconds, rows=rows,
+                rows_per_second=rows / seconds if seconds > 0 else None)
+
+
+###########
+# Micro   #
+###########
+
+def bench_encoder(args, vocab):
+    from deeppep.preprocessing.encoder import SequenceEncoder
+
+    sequences = synthetic_peptides(args.n, vocab, seed=args.seed)
+    results = {}
+    for one_hot in (False, True):
+        encoder = SequenceEncoder(PATTERN, dict(vocab), seq_len=50,
+                                  one_hot=one_hot, oov_warn=False)
+        name = "encoder.transform.{}".format("one_hot" if one_hot else "integer")
+        results[name] = _result(best_of(lambda: encoder.transform(sequences),
+                                        args.repeat),
+                                len(sequences))
+
+    return results
+
+def bench_consistency(args, vocab):
+    from deeppep.preprocessing import PreprocessingManager
+
+    # Tokenizing is what finds the unknown tokens the check rejects, so time
+    # both, on clean input and on input where every tenth peptide fails
+    manager = PreprocessingManager(PATTERN, dict(vocab), max(vocab.values()),
+                                   seq_len=50)
+    clean = synthetic_peptides(args.n, vocab, seed=args.seed)
+    dirty = [seq + "B" if ind % 10 == 0 else seq for ind, seq in enumerate(clean)]
+
+    def check(sequences):
+        _, oov_set = manager._integer_encode(sequences)
+        try:
+            manager._check_consistency(oov_set)
+        except Exception:
+            pass
+
+    return {
+        "preprocessing.check_consistency.clean" : _result(
+            best_of(lambda: check(clean), args.repeat), len(clean)
+        ),
+        "preprocessing.check_consistency.unknown_tokens" : _result(
+            best_of(lambda: check(dirty), args.repeat), len(dirty)
+        ),
+    }
+
+def bench_models(args, model_names):
+    from deeppep.manager import PipelineManager
+    from deeppep.types import Action, Peptide
+
+    results = {}
+    for model_name in model_names:
+        pipeline = PipelineManager(model_name)
+        spec = pipeline.model_config
+        manager = pipeline.prediction_manager()
+        sequences = synthetic_peptides(max(args.batch_sizes), pipeline.pre_config.vocab,
+                                       seed=args.seed)
+        encoded = pipeline.preprocessor().preprocess(sequences)
+
+        actions = ["predict"] + (["encode"] if spec.allow_encoding else [])
+        for batch_size in args.batch_sizes:
+            batch = encoded[:batch_size]
+            for action in actions:
+                run = getattr(manager, action)
+                # The first call at a new shape traces the model
+                run(batch)
+                name = "model.{}.{}.{}".format(model_name, action, batch_size)
+                results[name] = _result(best_of(lambda: run(batch), args.repeat),
+                                        batch_size, model=model_name,
+                                        action=action, batch_size=batch_size)
+
+        # Output building only reads the values, so repeat one batch's
+        predictions = pipeline.compute(sequences, Action.predict)
+        predictions = np.resize(predictions, (args.n, predictions.shape[1]))
+        peptides = [Peptide(sequence=seq, charge=2)
+                    for seq in synthetic_peptides(args.n, pipeline.pre_config.vocab,
+                                                  seed=args.seed)]
+        results["build_output.{}".format(model_name)] = _result(
+            best_of(lambda: pipeline._build_output(peptides, predictions), args.repeat),
+            len(peptides), model=model_name
+        )
+
+    return results
+
+
+###########
+# Load    #
+###########
+
+async def asgi_post(app, path, body):
+    """Send one POST request straight to an ASGI app, without a server."""
+    messages = [{"type" : "http.request", "body" : body, "more_body" : False}]
+    status, chunks = [None], []
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.sleep(3600)
+        return {"type" : "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status[0] = message["status"]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    scope = {"type" : "http", "asgi" : {"version" : "3.0"}, "http_version" : "1.1",
+             "method" : "POST", "scheme" : "http", "path" : path, "raw_path" : path.encode(),
+             "root_path" : "", "query_string" : b"", "server" : ("bench", 80),
+             "client" : ("bench", 1234),
+             "headers" : [(b"content-type", b"application/json"),
+                          (b"content-length", str(len(body)).encode())]}
+    await app(scope, receive, send)
+
+    return status[0], b"".join(chunks)
+
+def _percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+async def _load_level(app, path, bodies, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], [0]
+
+    async def one(body):
+        async with semaphore:
+            start = time.perf_counter()
+            status, _ = await asgi_post(app, path, body)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors[0] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(body) for body in bodies))
+    seconds = time.perf_counter() - start
+
+    return {"concurrency" : concurrency,
+            "requests" : len(bodies),
+            "seconds" : seconds,
+            "requests_per_second" : len(bodies) / seconds,
+            "p50" : _percentile(latencies, 50),
+            "p95" : _percentile(latencies, 95),
+            "p99" : _percentile(latencies, 99),
+            "errors" : errors[0]}
+
+def bench_load(args, model_names):
+    from deeppep.main import app
+    from deeppep.executor import shutdown_executor
+
+    results = {}
+    for model_name in model_names[:1] if args.load_models is None else args.load_models:
+        vocab = model_vocab(model_name)
+        path = "/models/{}/predict".format(model_name)
+
+        def bodies(count, seed):
+            # Fresh peptides per request so the caches cannot answer them
+            return [json.dumps({"peptides" : [
+                        {"sequence" : seq, "charge" : 2}
+                        for seq in synthetic_peptides(args.request_rows, vocab,
+                                                      seed=seed * 100003 + ind)
+                    ]}).encode() for ind in range(count)]
+
+        asyncio.run(_load_level(app, path, bodies(4, seed=-1), 1))
+        for level, concurrency in enumerate(args.concurrency):
+            name = "load.{}.c{}".format(model_name, concurrency)
+            results[name] = asyncio.run(_load_level(
+                app, path, bodies(args.requests, seed=args.seed + level), concurrency
+            ))
+            results[name].update(model=model_name, rows=args.request_rows)
+
+    shutdown_executor()
+    return results
+
+
+###############
+# Comparison  #
+###############
+
+def _tolerance(thresholds, name, metric):
+    for rule in thresholds:
+        if fnmatch.fnmatch(name, rule["case"]) and rule.get("metric", "seconds") == metric:
+            return rule
+
+    return None
+
+def compare(results, baseline, thresholds):
+    """Cases which got slower than their baseline by more than the tolerance.
+
+    Rules are matched in order, the first whose `case` pattern and `metric`
+    match is used. `regression` is the allowed relative increase over the
+    baseline and `max` an absolute ceiling which applies without one.
+    """
+    failures = []
+    metrics = sorted({rule.get("metric", "seconds") for rule in thresholds})
+    for name, result in sorted(results.items()):
+        for metric in metrics:
+            rule = _tolerance(thresholds, name, metric)
+            value = result.get(metric)
+            if rule is None or value is None:
+                continue
+
+            if "max" in rule and value > rule["max"]:
+                failures.append("{} {}: {:.6g} is above {:.6g}".format(
+                    name, metric, value, rule["max"]))
+
+            # Only runs over the same number of rows are comparable
+            old = baseline.get(name, {})
+            old = old.get(metric) if old.get("rows") == result.get("rows") else None
+            if "regression" in rule and old:
+                limit = old * (1 + rule["regression"])
+                if value > limit:
+                    failures.append("{} {}: {:.6g} vs {:.6g} in the baseline (+{:.0%})".format(
+                        name, metric, value, old, value / old - 1))
+
+    return failures
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+
+    # Only report TensorFlow if a benchmark loaded it
+    tf = sys.modules.get("tensorflow")
+    return {"commit" : commit or None,
+            "time" : time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python" : platform.python_version(),
+            "tensorflow" : getattr(tf, "__version__", None),
+            "numpy" : np.__version__,
+            "platform" : platform.platform(),
+            "cpus" : os.cpu_count()}
+
+
+########
+# Main #
+########
+
+GROUPS = ("encoder", "consistency", "models", "load")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", "-o", required=True)
+    parser.add_argument("--baseline", "-b",
+                        help="Earlier results to compare against")
+    parser.add_argument("--thresholds", default=THRESHOLDS)
+    parser.add_argument("--only", nargs="*", choices=GROUPS, default=list(GROUPS))
+    parser.add_argument("--models", nargs="*", default=None,
+                        help="Models to benchmark, every shipped model by default")
+    parser.add_argument("--n", type=int, default=20000,
+                        help="Peptides for the tokenization and output benchmarks")
+    parser.add_argument("--batch-sizes", type=int, nargs="*", default=[1, 32, 256, 2048])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, nargs="*", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=64,
+                        help="Requests sent at each concurrency level")
+    parser.add_argument("--request-rows", type=int, default=50)
+    parser.add_argument("--load-models", nargs="*", default=None,
+                        help="Models to load test, the first benchmarked model by default")
+    parser.add_argument("--seed", type=int, default=0)
+
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    # Caches would answer repeated inputs without doing the work being timed,
+    # and a bulk job runner has no place in a benchmark
+    for key in ("DEEPPEP_ENCODING_CACHE_ENTRIES", "DEEPPEP_RESULT_CACHE_ENTRIES",
+                "DEEPPEP_MAX_ACTIVE_JOBS"):
+        os.environ.setdefault(key, "0")
+
+    from deeppep.config import get_model_info
+    from deeppep.types import DEFAULT_VOCAB
+
+    model_names = args.models or sorted(get_model_info())
+    vocab = dict(DEFAULT_VOCAB)
+    for model_name in model_names:
+        vocab.update(model_vocab(model_name))
+
+    results = {}
+    for group in GROUPS:
+        if group not in args.only:
+            continue
+        print("Running {} benchmarks".format(group), file=sys.stderr, flush=True)
+        if group == "encoder":
+            results.update(bench_encoder(args, vocab))
+        elif group == "consistency":
+            results.update(bench_consistency(args, vocab))
+        elif group == "models":
+            results.update(bench_models(args, model_names))
+        else:
+            results.update(bench_load(args, model_names))
+
+    report = {"environment" : environment(),
+              "arguments" : vars(args),
+              "results" : results}
+    with open(args.output, "w") as handle:
+        json.dump(report, handle, indent=2, sort_keys=True)
+
+    for name, result in sorted(results.items()):
+        if "p95" in result:
+            print("{:<48} {:8.1f} req/s  p50 {:7.1f}ms  p95 {:7.1f}ms  errors {}".format(
+                name, result["requests_per_second"], result["p50"] * 1000,
+                result["p95"] * 1000, result["errors"]))
+        else:
+            print("{:<48} {:10.4f}s  {:12,.0f} rows/s".format(
+                name, result["seconds"], result["rows_per_second"]))
+
+    with open(args.thresholds) as handle:
+        thresholds = json.load(handle)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)["results"]
+
+    failures = compare(results, baseline, thresholds)
+    for failure in failures:
+        print("REGRESSION " + failure, file=sys.stderr)
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,295 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from fastapi import HTTPException
+from .config import get_app_config
+from .metrics import counter, gauge
+
+REJECTIONS = counter("deeppep_admission_rejections_total",
+                     "Requests turned away before running",
+                     labels=("reason",))
+
+# Arrival time and client timeout of the request being handled
+_arrival = ContextVar("deeppep_arrival", default=None)
+# Time after which work for the current request is dropped
+_deadline = ContextVar("deeppep_deadline", default=None)
+
+
+#############
+# Deadlines #
+#############
+
+class DeadlineMiddleware:
+    """ASGI middleware noting when each request arrived.
+
+    Clients may send X-Request-Timeout in seconds to shorten the server's
+    DEEPPEP_REQUEST_TIMEOUT for their request. The deadline only applies
+    to work started through `admit`.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        client_timeout = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-timeout":
+                try:
+                    client_timeout = float(value)
+                except ValueError:
+                    pass
+
+        token = _arrival.set((time.time(), client_timeout))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _arrival.reset(token)
+
+def current_deadline():
+    return _deadline.get()
+
+@contextmanager
+def deadline_scope(deadline):
+    """Run work, e.g. in an executor process, under a request's deadline."""
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def _deadline_message(model_name):
+    message = " ".join([
+        "DEADLINE ERROR:",
+        "The request ran out of time before model {} could run.",
+        "Send fewer peptides per request or a longer X-Request-Timeout."
+        ]).format(model_name)
+
+    return message
+
+def check_deadline(model_name):
+    """Drop work for a request whose client has stopped waiting."""
+    deadline = _deadline.get()
+    if deadline is not None and time.time() > deadline:
+        REJECTIONS.inc(reason="deadline")
+        raise HTTPException(status_code = 504,
+                            detail = _deadline_message(model_name))
+
+def _request_deadline(start=None):
+    timeout = get_app_config()["request_timeout"]
+    arrival, client_timeout = _arrival.get() or (time.time(), None)
+    if start is not None:
+        arrival = start
+    if client_timeout is not None and client_timeout > 0:
+        timeout = min(timeout, client_timeout) if timeout > 0 else client_timeout
+    if timeout <= 0:
+        return None
+
+    return arrival + timeout
+
+
+#############
+# Admission #
+#############
+
+def _too_large_message(rows, max_rows, model_name):
+    message = " ".join([
+        "REQUEST TOO LARGE:",
+        "Received {} peptides but at most {} are accepted per request.",
+        "Send larger sets to /models/{}/{{action}}/stream",
+        "or submit them as a bulk job to /jobs."
+        ]).format(rows, max_rows, model_name)
+
+    return message
+
+def _multi_too_large_message(rows, max_rows, model_names):
+    message = " ".join([
+        "REQUEST TOO LARGE:",
+        "Received {} peptides for {} models, {} rows in all,",
+        "but at most {} rows are accepted per request.",
+        "Split the peptides over several requests,",
+        "or submit them as one bulk job to /jobs?models={}."
+        ]).format(rows // len(model_names), len(model_names), rows, max_rows,
+                  "&models=".join(model_names))
+
+    return message
+
+def _queue_full_message(model_name):
+    message = " ".join([
+        "SERVER BUSY:",
+        "Too many requests for model {} are already waiting.",
+        "Retry after the time given in the Retry-After header."
+        ]).format(model_name)
+
+    return message
+
+def _saturated_message():
+    message = " ".join([
+        "SERVER BUSY:",
+        "No capacity became free while the request waited.",
+        "Retry after the time given in the Retry-After header."
+        ])
+
+    return message
+
+
+class AdmissionController:
+    """Caps the peptide rows a server worker works on at once.
+
+    A request is admitted straight away if its rows fit under `max_rows`
+    and nobody is waiting. Otherwise it waits in a bounded queue for its
+    model, up to `queue_timeout` seconds or its deadline. Queues are served
+    FIFO and in turn across models, so one busy model cannot starve the
+    others. A request for several models waits in each of their queues,
+    counts against each queue's bound, and is admitted once from whichever
+    reaches it first. A request larger than `max_rows` runs alone.
+
+    All methods run on the event loop of the worker.
+
+    """
+    def __init__(self, max_rows, queue_size, queue_timeout, retry_after):
+        self.max_rows = max_rows
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.rows = 0
+        self._queues = OrderedDict()
+
+    def _busy(self, status_code, detail, reason):
+        REJECTIONS.inc(reason=reason)
+        return HTTPException(status_code = status_code,
+                             detail = detail,
+                             headers = {"Retry-After" : str(self.retry_after)})
+
+    def _fits(self, rows):
+        return self.rows == 0 or self.rows + rows <= self.max_rows
+
+    def queued(self):
+        return len({entry for queue in self._queues.values() for entry in queue})
+
+    def _dequeue(self, entry, model_names):
+        for model_name in model_names:
+            queue = self._queues.get(model_name)
+            if queue is not None and entry in queue:
+                queue.remove(entry)
+                if not queue:
+                    del self._queues[model_name]
+
+    async def acquire(self, model_names, rows, timeout=None):
+        if isinstance(model_names, str):
+            model_names = (model_names,)
+        model_names = tuple(dict.fromkeys(model_names))
+        if self.max_rows <= 0 or (not self._queues and self._fits(rows)):
+            self.rows += rows
+            return
+
+        for model_name in model_names:
+            if len(self._queues.get(model_name, ())) >= self.queue_size:
+                raise self._busy(429, _queue_full_message(model_name), "queue_full")
+
+        future = asyncio.get_event_loop().create_future()
+        entry = (rows, future, model_names)
+        for model_name in model_names:
+            self._queues.setdefault(model_name, deque()).append(entry)
+
+        wait = self.queue_timeout if timeout is None else min(self.queue_timeout, timeout)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), max(wait, 0))
+        except BaseException as err:
+            if future.done():
+                # Admitted just as the wait ended
+                if isinstance(err, asyncio.TimeoutError):
+                    return
+                self.release(rows)
+                raise
+
+            self._dequeue(entry, model_names)
+            if isinstance(err, asyncio.TimeoutError):
+                raise self._busy(503, _saturated_message(), "saturated")
+            raise
+
+    def release(self, rows):
+        self.rows -= rows
+        admitted = True
+        while admitted and self._queues:
+            admitted = False
+            for model_name in list(self._queues):
+                queue = self._queues.get(model_name)
+                if queue is None:
+                    # Emptied by an entry admitted from another queue
+                    continue
+                if self._fits(queue[0][0]):
+                    entry = queue[0]
+                    rows, future, model_names = entry
+                    self._dequeue(entry, model_names)
+                    self.rows += rows
+                    future.set_result(None)
+                    admitted = True
+                    if model_name in self._queues:
+                        self._queues.move_to_end(model_name)
+
+    def check_size(self, model_names, rows):
+        max_request_rows = get_app_config()["max_request_rows"]
+        if max_request_rows > 0 and rows > max_request_rows:
+            REJECTIONS.inc(reason="too_large")
+            if len(model_names) > 1:
+                detail = _multi_too_large_message(rows, max_request_rows, model_names)
+            else:
+                detail = _too_large_message(rows, max_request_rows, model_names[0])
+            raise HTTPException(status_code = 413, detail = detail)
+
+
+_admission = None
+_admission_lock = threading.Lock()
+
+def get_admission():
+    global _admission
+    with _admission_lock:
+        if _admission is None:
+            app_config = get_app_config()
+            _admission = AdmissionController(
+                max_rows=app_config["max_inflight_rows"],
+                queue_size=app_config["model_queue_size"],
+                queue_timeout=app_config["queue_timeout"],
+                retry_after=app_config["retry_after"]
+            )
+
+    return _admission
+
+gauge("deeppep_inflight_rows", "Peptide rows admitted and not yet finished",
+      fn=lambda: _admission.rows if _admission is not None else None)
+gauge("deeppep_queued_requests", "Requests waiting for admission",
+      fn=lambda: _admission.queued() if _admission is not None else None)
+
+@asynccontextmanager
+async def admit(model_names, rows, start=None):
+    """Hold a share of the worker's capacity while handling a request.
+
+    `model_names` is the model a request runs, or a list of the models it
+    runs one after another, in which case `rows` counts each peptide once
+    per model.
+
+    Raises 413 for requests over the size limit, 429 when the model's
+    queue is full, 503 when waiting did not free enough capacity, and
+    sets the deadline checked before each model runs. The deadline counts
+    from the request's arrival, or from `start` for work such as stream
+    chunks which begins long after it.
+    """
+    admission = get_admission()
+    if isinstance(model_names, str):
+        model_names = [model_names]
+    admission.check_size(model_names, rows)
+
+    deadline = _request_deadline(start)
+    timeout = None if deadline is None else deadline - time.time()
+    await admission.acquire(model_names, rows, timeout)
+    try:
+        with deadline_scope(deadline):
+            yield
+    finally:
+        admission.release(rows)
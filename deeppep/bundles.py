@@ -0,0 +1,192 @@
+import os
+import re
+import threading
+import zipfile
+from glob import glob
+from hashlib import sha1
+from fastapi import HTTPException, Response
+from fastapi.responses import FileResponse, StreamingResponse
+from .config import get_app_config, get_spec_index
+from .prediction.cache import file_digest
+from .versions import pinned_name
+
+ZIP = "application/zip"
+_SPEC_FIELDS_DROPPED = {"config_path", "weight_path"}
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def _model_unavailable_message(model_name):
+    message = " ".join([
+        "Model Not Found:",
+        "The model, {}, could not be found or is not available for download.",
+        "Please send an OPTIONS request to the following address",
+        "in order to get a list of available models: /models"
+        ]).format(model_name)
+
+    return message
+
+def _file_base(spec):
+    return os.path.basename(spec.config_path)[:-len(".config.json")]
+
+def bundle_name(spec):
+    return pinned_name(spec.model_name, spec.version)
+
+def _spec_json(spec):
+    # Paths are local to this server and rebuilt wherever the spec is loaded
+    return spec.json(exclude=_SPEC_FIELDS_DROPPED, indent=2)
+
+
+class BundleStore:
+    """Zip bundles of model files packed once and kept on disk.
+
+    A bundle holds the spec, config and weights under the names the model
+    directory loader expects, so it can be unpacked into DEEPPEP_MODEL_DIR
+    as it is. Bundles are named after a digest of their contents, which
+    doubles as their ETag, and repacked only when a model file changes.
+
+    """
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def digest(self, spec):
+        parts = [file_digest(spec.config_path),
+                 file_digest(spec.weight_path),
+                 sha1(_spec_json(spec).encode()).hexdigest()]
+        return sha1("\0".join(parts).encode()).hexdigest()
+
+    def path(self, spec, digest):
+        return os.path.join(self.root, "{}-{}.zip".format(bundle_name(spec), digest[:16]))
+
+    def _pack(self, spec, path):
+        base = _file_base(spec)
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as bundle:
+            bundle.writestr(base + ".spec.json", _spec_json(spec))
+            bundle.write(spec.config_path, base + ".config.json")
+            bundle.write(spec.weight_path, base + ".weights.h5")
+
+        # Workers packing the same bundle at once each rename a whole file
+        os.replace(tmp_path, path)
+        for old_path in glob(os.path.join(self.root, bundle_name(spec) + "-*.zip")):
+            if old_path != path:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+    def get(self, spec):
+        digest = self.digest(spec)
+        path = self.path(spec, digest)
+        with self._lock:
+            if not os.path.exists(path):
+                self._pack(spec, path)
+
+        return path, digest
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_bundle_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = BundleStore(get_app_config()["bundle_dir"])
+
+    return _store
+
+def get_bundle(model_name):
+    spec = get_spec_index().lookup(model_name)
+    if spec is None or not spec.public:
+        raise HTTPException(status_code = 404,
+                            detail = _model_unavailable_message(model_name))
+
+    try:
+        path, digest = get_bundle_store().get(spec)
+    except OSError:
+        raise HTTPException(status_code = 404,
+                            detail = _model_unavailable_message(model_name))
+
+    return spec, path, digest
+
+
+#############
+# Responses #
+#############
+
+def _etag_matches(header, etag):
+    if header is None:
+        return False
+    if header.strip() == "*":
+        return True
+
+    # Weak comparison, as If-None-Match calls for
+    tags = [tag.strip() for tag in header.split(",")]
+    return any((tag[2:] if tag.startswith("W/") else tag) == etag for tag in tags)
+
+def parse_range(header, size):
+    """First and last byte of a single range request, or None to send it all.
+
+    Raises ValueError if the range cannot be satisfied.
+    """
+    if header is None or "," in header:
+        return None
+
+    match = _RANGE.match(header.strip())
+    if match is None or match.groups() == ("", ""):
+        return None
+
+    first, last = match.groups()
+    if first == "":
+        # Suffix range, the final bytes of the file
+        first, last = max(0, size - int(last)), size - 1
+    else:
+        first = int(first)
+        last = min(int(last), size - 1) if last else size - 1
+
+    if first >= size or first > last:
+        raise ValueError(header)
+
+    return first, last
+
+def _iter_file(path, first, last, block_size=2**16):
+    with open(path, "rb") as handle:
+        handle.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            block = handle.read(min(block_size, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+def bundle_response(path, digest, filename, range_header=None,
+                    if_none_match=None, if_range=None):
+    etag = '"{}"'.format(digest)
+    headers = {"ETag" : etag,
+               "Accept-Ranges" : "bytes",
+               "Cache-Control" : "no-cache"}
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    # A range of an older bundle would splice two files together
+    if if_range is not None and if_range.strip() != etag:
+        range_header = None
+
+    size = os.path.getsize(path)
+    try:
+        byte_range = parse_range(range_header, size)
+    except ValueError:
+        headers["Content-Range"] = "bytes */{}".format(size)
+        return Response(status_code=416, headers=headers)
+
+    if byte_range is None:
+        return FileResponse(path, media_type=ZIP, filename=filename, headers=headers)
+
+    first, last = byte_range
+    headers["Content-Range"] = "bytes {}-{}/{}".format(first, last, size)
+    headers["Content-Length"] = str(last - first + 1)
+    headers["Content-Disposition"] = 'attachment; filename="{}"'.format(filename)
+    return StreamingResponse(_iter_file(path, first, last),
+                             status_code=206, media_type=ZIP, headers=headers)
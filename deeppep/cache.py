@@ -0,0 +1,74 @@
+import threading
+from collections import OrderedDict
+
+
+class RowCache:
+    """LRU cache of array rows keyed by a namespace and a sequence.
+
+    Rows are stored as raw bytes so that a batch of hits can be turned
+    back into a matrix with a single join and `np.frombuffer`. The cache is
+    bounded both by number of entries and by the bytes held in keys and rows.
+
+    """
+    def __init__(self, max_entries=200000, max_bytes=64 * 2**20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._rows = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_size(self, key, row):
+        return len(key[1]) + len(row)
+
+    def get_many(self, namespace, sequences):
+        rows = []
+        with self._lock:
+            for seq in sequences:
+                key = (namespace, seq)
+                row = self._rows.get(key)
+                if row is not None:
+                    self._rows.move_to_end(key)
+                rows.append(row)
+
+            hits = sum(row is not None for row in rows)
+            self.hits += hits
+            self.misses += len(rows) - hits
+
+        return rows
+
+    def put_many(self, namespace, sequences, rows):
+        with self._lock:
+            for seq, row in zip(sequences, rows):
+                key = (namespace, seq)
+                if not isinstance(row, bytes):
+                    row = row.tobytes()
+                old = self._rows.pop(key, None)
+                if old is not None:
+                    self._nbytes -= self._entry_size(key, old)
+
+                self._rows[key] = row
+                self._nbytes += self._entry_size(key, row)
+
+            while self._rows and (len(self._rows) > self.max_entries
+                                  or self._nbytes > self.max_bytes):
+                key, row = self._rows.popitem(last=False)
+                self._nbytes -= self._entry_size(key, row)
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._rows),
+                "bytes": self._nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.,
+            }
@@ -0,0 +1,304 @@
+"""Run models over peptide files without going through the HTTP server.
+
+Run from the repository root:
+
+    python -m deeppep peptides.csv -m standard_rt -m standard_charge -o out.csv
+    python -m deeppep human.fasta -m standard_rt -o rt.parquet --workers 4
+    python -m deeppep peptides.txt -m standard_rt -a encode -o enc.npy
+
+Input is read lazily and split into chunks which are sent to a pool of
+worker processes, each building its models once. Only a fixed window
+of chunks is in flight at a time and results are written out in input
+order as they arrive, so memory use does not grow with the input.
+
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from fastapi import HTTPException
+from .io import guess_format, read_peptides, output_columns, format_rows
+from .jobs.worker import init_worker
+from .manager import compute_pipeline
+from .types import Action, InputFormat, UserConfig
+
+
+###########
+# Workers #
+###########
+
+def compute_chunk(models, user_config, sequences, action, layer=None):
+    """Outputs of every model side by side.
+
+    Returns:
+        str: Error message if a model rejected the chunk, otherwise None.
+        np.ndarray: Output matrix with one row per sequence.
+        List[str]: Output column names.
+    """
+    blocks, columns = [], []
+    for model_name in models:
+        try:
+            values, labels, _ = compute_pipeline(model_name, user_config,
+                                                 sequences, action, layer)
+        except HTTPException as err:
+            return "{}: {}".format(model_name, err.detail), None, None
+
+        blocks.append(values.astype(np.float32, copy=False))
+        columns.extend(output_columns(model_name, labels, values.shape[1]))
+
+    return None, np.hstack(blocks), columns
+
+def iter_chunks(peptides, chunk_size):
+    sequences, charges = [], []
+    for sequence, charge in peptides:
+        sequences.append(sequence)
+        charges.append(charge)
+        if len(sequences) == chunk_size:
+            yield sequences, charges
+            sequences, charges = [], []
+
+    if sequences:
+        yield sequences, charges
+
+
+###########
+# Writers #
+###########
+
+class CSVWriter:
+    def __init__(self, path):
+        self.handle = open(path, "w", newline="")
+        self.writer = csv.writer(self.handle)
+        self.header_written = False
+
+    def write(self, sequences, charges, values, columns):
+        has_charges = any(charge is not None for charge in charges)
+        if not self.header_written:
+            header = ["sequence", "charge"] if has_charges else ["sequence"]
+            self.writer.writerow(header + columns)
+            self.header_written = True
+
+        self.writer.writerows(format_rows(sequences,
+                                          charges if has_charges else None,
+                                          values))
+
+    def close(self):
+        self.handle.close()
+
+
+class ParquetWriter:
+    def __init__(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Writing parquet files requires pyarrow")
+
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = path
+        self.writer = None
+
+    def write(self, sequences, charges, values, columns):
+        arrays = [self.pa.array(sequences, type=self.pa.string()),
+                  self.pa.array(charges, type=self.pa.int32())]
+        arrays.extend(self.pa.array(values[:, ind]) for ind in range(values.shape[1]))
+        batch = self.pa.RecordBatch.from_arrays(arrays,
+                                                names=["sequence", "charge"] + columns)
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.path, batch.schema)
+
+        self.writer.write_table(self.pa.Table.from_batches([batch]))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class NpyWriter:
+    """Fills a memory mapped .npy file of known length, one chunk at a time.
+
+    Only the output matrix is stored; rows follow the input order and the
+    column names are saved alongside as <output>.columns.json.
+    """
+    def __init__(self, path, rows):
+        self.path = path
+        self.rows = rows
+        self.array = None
+        self.offset = 0
+
+    def write(self, sequences, charges, values, columns):
+        if self.array is None:
+            self.array = np.lib.format.open_memmap(self.path, mode="w+",
+                                                   dtype=np.float32,
+                                                   shape=(self.rows, values.shape[1]))
+            with open(self.path + ".columns.json", "w") as handle:
+                json.dump(columns, handle)
+
+        self.array[self.offset:self.offset + len(values)] = values
+        self.offset += len(values)
+
+    def close(self):
+        if self.array is not None:
+            self.array.flush()
+            del self.array
+
+
+############
+# Progress #
+############
+
+class Progress:
+    def __init__(self, total=None, interval=5., stream=sys.stderr):
+        self.total = total
+        self.interval = interval
+        self.stream = stream
+        self.rows = 0
+        self.start = time.perf_counter()
+        self.last_report = self.start
+
+    def update(self, rows):
+        self.rows += rows
+        now = time.perf_counter()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report()
+
+    def report(self, final=False):
+        elapsed = time.perf_counter() - self.start
+        rate = self.rows / elapsed if elapsed > 0 else 0.
+        done = "{:,}".format(self.rows)
+        if self.total:
+            done += " / {:,}".format(self.total)
+        print("{} {} peptides in {:.1f}s, {:,.0f} peptides/s".format(
+                  "Finished" if final else "Processed", done, elapsed, rate),
+              file=self.stream, flush=True)
+
+
+########
+# Main #
+########
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m deeppep",
+        description="Run DeepPep models over a peptide file."
+        )
+    parser.add_argument("input",
+                        help="CSV/TSV with a sequence column, text with one"
+                             " sequence per line, or FASTA; - reads stdin")
+    parser.add_argument("-m", "--model", dest="models", action="append",
+                        required=True,
+                        help="Model to run, repeat to run several")
+    parser.add_argument("-o", "--output", required=True,
+                        help="Output file, its suffix picks the format:"
+                             " .csv, .parquet or .npy")
+    parser.add_argument("-a", "--action", type=Action, default=Action.predict,
+                        choices=list(Action))
+    parser.add_argument("--layer",
+                        help="Layer name or index to take encodings from,"
+                             " by default the layer before the output")
+    parser.add_argument("-f", "--format", type=InputFormat, choices=list(InputFormat),
+                        help="Input format, guessed from the file name by default")
+    parser.add_argument("--config", type=json.loads,
+                        help='Preprocessing overrides as JSON, e.g.'
+                             ' \'{"vocab": {"S[80]": 24}}\'')
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Worker processes, 0 runs in this process")
+    parser.add_argument("--threads", type=int,
+                        help="TF threads per worker, by default the cores"
+                             " are split evenly between workers")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--missed-cleavages", type=int, default=0)
+    parser.add_argument("--min-length", type=int, default=7)
+    parser.add_argument("--max-length", type=int, default=50)
+
+    return parser
+
+def _open_input(path):
+    if path == "-":
+        return sys.stdin
+
+    return open(path, "r", encoding="utf-8", newline="")
+
+def _open_writer(args, read_input):
+    suffix = os.path.splitext(args.output)[1].lower()
+    if suffix == ".parquet":
+        return ParquetWriter(args.output), None
+    if suffix == ".npy":
+        if args.input == "-":
+            raise SystemExit("Writing .npy needs a file input to count rows first")
+
+        # The memory map is sized up front, so count the rows first
+        with _open_input(args.input) as handle:
+            rows = sum(1 for _ in read_input(handle))
+        return NpyWriter(args.output, rows), rows
+
+    return CSVWriter(args.output), None
+
+def run(args):
+    fmt = args.format or guess_format(filename=args.input)
+    digest_args = {"missed_cleavages" : args.missed_cleavages,
+                   "min_length" : args.min_length,
+                   "max_length" : args.max_length}
+    read_input = lambda handle: read_peptides(handle, fmt, **digest_args)
+    user_config = UserConfig(**args.config) if args.config else None
+
+    writer, total = _open_writer(args, read_input)
+    progress = Progress(total)
+
+    pool = None
+    if args.workers > 0:
+        threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+        pool = ProcessPoolExecutor(max_workers=args.workers,
+                                   mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=init_worker,
+                                   initargs=(0, threads))
+
+    # Chunks stay queued in order, writing waits on the oldest one
+    window = deque()
+    max_in_flight = 2 * max(1, args.workers)
+
+    def write_oldest():
+        sequences, charges, result = window.popleft()
+        error, values, columns = result.result() if pool else result
+        if error is not None:
+            raise SystemExit(error)
+
+        writer.write(sequences, charges, values, columns)
+        progress.update(len(sequences))
+
+    try:
+        with _open_input(args.input) as handle:
+            for sequences, charges in iter_chunks(read_input(handle), args.chunk_size):
+                if pool is not None:
+                    result = pool.submit(compute_chunk, args.models, user_config,
+                                         sequences, args.action, args.layer)
+                else:
+                    result = compute_chunk(args.models, user_config,
+                                           sequences, args.action, args.layer)
+                window.append((sequences, charges, result))
+                if len(window) >= max_in_flight:
+                    write_oldest()
+
+        while window:
+            write_oldest()
+
+    except HTTPException as err:
+        raise SystemExit(err.detail)
+
+    finally:
+        writer.close()
+        if pool is not None:
+            pool.shutdown()
+
+    progress.report(final=True)
+
+def main(argv=None):
+    run(build_parser().parse_args(argv))
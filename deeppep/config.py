@@ -1,8 +1,12 @@
 from re import sub
 from json import load
-from os import environ, path
+from os import environ, path, cpu_count
+from tempfile import gettempdir
 from glob import glob
-from .types import PreprocessingConfig, ModelSpec
+from time import monotonic
+from threading import Lock
+from .types import PreprocessingConfig, ModelSpec, ModelSummary, merge_configs
+from .metrics import timed, set_model_filter
 
 def get_app_config():
     config = {}
@@ -12,6 +16,83 @@ def get_app_config():
     config["model_dir_default"] = path.join(config["app_dir"], "models")
     config["model_dir_user"] = environ.get("DEEPPEP_MODEL_DIR")
 
+    # Models loaded and run once at startup, "*" for all of them
+    config["preload_models"] = environ.get("DEEPPEP_PRELOAD_MODELS", "")
+
+    # Model caching variables
+    config["model_cache_mb"] = float(environ.get("DEEPPEP_MODEL_CACHE_MB", 0))
+    config["spec_refresh"] = float(environ.get("DEEPPEP_SPEC_REFRESH", 5))
+
+    # Warm up new model versions in the background and swap them in once
+    # ready, otherwise requests move to a new version as soon as it is seen
+    config["rollout"] = environ.get("DEEPPEP_ROLLOUT", "1") == "1"
+
+    # Micro batching variables
+    config["batch_max_size"] = int(environ.get("DEEPPEP_BATCH_MAX_SIZE", 1024))
+    config["batch_max_wait_ms"] = float(environ.get("DEEPPEP_BATCH_MAX_WAIT_MS", 0))
+
+    # Preprocessing variables
+    config["one_hot_chunk_size"] = int(environ.get("DEEPPEP_ONE_HOT_CHUNK_SIZE", 4096))
+    config["encoding_cache_entries"] = int(environ.get("DEEPPEP_ENCODING_CACHE_ENTRIES",
+                                                       200000))
+    config["encoding_cache_mb"] = float(environ.get("DEEPPEP_ENCODING_CACHE_MB", 64))
+
+    # Prediction result cache variables
+    config["result_cache_entries"] = int(environ.get("DEEPPEP_RESULT_CACHE_ENTRIES",
+                                                     100000))
+    config["result_cache_mb"] = float(environ.get("DEEPPEP_RESULT_CACHE_MB", 128))
+    config["result_cache_path"] = environ.get("DEEPPEP_RESULT_CACHE_PATH", "")
+    config["result_cache_disk_rows"] = int(environ.get("DEEPPEP_RESULT_CACHE_DISK_ROWS",
+                                                       1000000))
+
+    # Width of length buckets for masked models, 0 runs fully padded batches
+    config["bucket_width"] = int(environ.get("DEEPPEP_BUCKET_WIDTH", 0))
+
+    # Rows per call into the compiled sub-model behind the encode action
+    config["encode_batch_size"] = int(environ.get("DEEPPEP_ENCODE_BATCH_SIZE", 256))
+
+    # Send per stage timings back in Server-Timing response headers
+    config["server_timing"] = environ.get("DEEPPEP_SERVER_TIMING", "0") == "1"
+
+    # Admission control per server worker. Peptide rows being worked on at
+    # once, requests waiting per model and seconds they may wait, all 0 to
+    # disable, and the Retry-After sent when turning requests away
+    config["max_inflight_rows"] = int(environ.get("DEEPPEP_MAX_INFLIGHT_ROWS", 20000))
+    config["model_queue_size"] = int(environ.get("DEEPPEP_MODEL_QUEUE_SIZE", 32))
+    config["queue_timeout"] = float(environ.get("DEEPPEP_QUEUE_TIMEOUT", 5))
+    config["retry_after"] = int(environ.get("DEEPPEP_RETRY_AFTER", 1))
+
+    # Largest request accepted outside of streaming and jobs, and seconds
+    # after arrival when its work is dropped, 0 for no limit
+    config["max_request_rows"] = int(environ.get("DEEPPEP_MAX_REQUEST_ROWS", 20000))
+    config["request_timeout"] = float(environ.get("DEEPPEP_REQUEST_TIMEOUT", 25))
+
+    # Rows processed per step by the streaming endpoint
+    config["stream_chunk_size"] = int(environ.get("DEEPPEP_STREAM_CHUNK_SIZE", 1000))
+
+    # Packed model downloads served by GET /models/{model_name}
+    config["bundle_dir"] = environ.get("DEEPPEP_BUNDLE_DIR",
+                                       path.join(gettempdir(), "deeppep-bundles"))
+
+    # Bulk job variables, jobs only survive a restart if jobs_dir does
+    config["jobs_dir"] = environ.get("DEEPPEP_JOBS_DIR",
+                                     path.join(gettempdir(), "deeppep-jobs"))
+    config["job_chunk_size"] = int(environ.get("DEEPPEP_JOB_CHUNK_SIZE", 50000))
+    config["max_active_jobs"] = int(environ.get("DEEPPEP_MAX_ACTIVE_JOBS", 1))
+    config["job_workers"] = int(environ.get("DEEPPEP_JOB_WORKERS", 1))
+    config["job_tf_threads"] = int(environ.get("DEEPPEP_JOB_TF_THREADS", 1))
+    config["max_upload_mb"] = float(environ.get("DEEPPEP_MAX_UPLOAD_MB", 1024))
+
+    # Compute variables, TF threads are split evenly across server workers
+    config["nworkers"] = int(environ.get("DEEPPEP_NWORKERS", 1))
+    worker_cores = max(1, (cpu_count() or 1) // config["nworkers"])
+    config["executor_kind"] = environ.get("DEEPPEP_EXECUTOR", "thread")
+    config["executor_workers"] = int(environ.get("DEEPPEP_EXECUTOR_WORKERS", 4))
+    config["tf_intra_threads"] = int(environ.get("DEEPPEP_TF_INTRA_THREADS",
+                                                 worker_cores))
+    config["tf_inter_threads"] = int(environ.get("DEEPPEP_TF_INTER_THREADS",
+                                                 min(2, worker_cores)))
+
     return config
 
 def load_model_spec(spec_file):
@@ -35,15 +116,166 @@ def load_all_specs(model_dir):
         glob(path.join(model_dir, "*.spec.json"))
         )
 
-    model_spec_dict = {spec.model_name : spec 
+    model_spec_dict = {(spec.model_name, spec.version) : spec
                        for spec in model_spec_iter}
     return model_spec_dict
 
-def get_model_info():
-    app_config = get_app_config()
-    model_info = load_all_specs(app_config["model_dir_default"])
+def version_key(version):
+    # Unversioned specs sort first and numeric parts compare as numbers,
+    # so "1.10" follows "1.9"
+    if version is None:
+        return ()
+
+    return tuple((0, int(part), "") if part.isdigit() else (1, 0, part)
+                 for part in sub(r"[.\-_+]", " ", version).split())
+
+def newest_version(versions):
+    return max(versions, key=version_key)
+
+def split_model_name(model_name):
+    """Split "name@version" into its parts, the version being None if absent."""
+    name, _, version = model_name.partition("@")
+    return name, version or None
+
+def get_model_dirs(app_config):
+    model_dirs = [app_config["model_dir_default"]]
     if app_config["model_dir_user"]:
-        model_info.update(load_all_specs(app_config["model_dir_user"]))
+        model_dirs.append(app_config["model_dir_user"])
+
+    return model_dirs
+
+def load_model_info():
+    """Specs of every model version, keyed by model name and then version."""
+    model_info = {}
+    for model_dir in get_model_dirs(get_app_config()):
+        for (model_name, version), spec in load_all_specs(model_dir).items():
+            model_info.setdefault(model_name, {})[version] = spec
 
     return model_info
 
+class SpecIndex:
+    """In memory index of model specs keyed by model name.
+
+    A model may have several versions on disk, `get` maps each name to the
+    newest and `versions` returns all of them. Specs are read from disk
+    once and served from memory afterwards. At most
+    once every `refresh_interval` seconds the modification times of the model
+    directories and spec files are compared against those seen at the last
+    load, and the index is rebuilt if anything changed. A negative interval
+    disables the check so that only `reload` rebuilds the index.
+
+    """
+    def __init__(self, refresh_interval=5.):
+        self.refresh_interval = refresh_interval
+        self._specs = None
+        self._versions = {}
+        self._listing = None
+        self._signature = None
+        self._checked = 0.
+        self._lock = Lock()
+
+    def _current_signature(self):
+        signature = []
+        for model_dir in get_model_dirs(get_app_config()):
+            if not path.exists(model_dir):
+                continue
+
+            signature.append((model_dir, path.getmtime(model_dir)))
+            for spec_file in sorted(glob(path.join(model_dir, "*.spec.json"))):
+                signature.append((spec_file, path.getmtime(spec_file)))
+
+        return tuple(signature)
+
+    def _needs_refresh(self):
+        if self._specs is None:
+            return True
+
+        if self.refresh_interval < 0:
+            return False
+
+        now = monotonic()
+        if now - self._checked < self.refresh_interval:
+            return False
+
+        self._checked = now
+        return self._current_signature() != self._signature
+
+    def reload(self):
+        with self._lock:
+            signature = self._current_signature()
+            self._versions = load_model_info()
+            self._specs = {model_name : versions[newest_version(versions)]
+                           for model_name, versions in self._versions.items()}
+            self._listing = None
+            self._signature = signature
+            self._checked = monotonic()
+
+        return self._specs
+
+    def get(self):
+        with timed("spec_index"):
+            if self._needs_refresh():
+                return self.reload()
+
+            return self._specs
+
+    def versions(self, model_name):
+        self.get()
+        return self._versions.get(model_name, {})
+
+    def lookup(self, model_name):
+        """Newest spec of a model, or of the version pinned as name@version."""
+        model_name, version = split_model_name(model_name)
+        if version is None:
+            return self.get().get(model_name)
+
+        return self.versions(model_name).get(version)
+
+    def listing(self):
+        """Summaries of the public models, built once per load of the index.
+
+        Served from memory without checking the model directories, which
+        other lookups keep up to date.
+        """
+        specs = self._specs if self._specs is not None else self.get()
+        with self._lock:
+            if self._listing is None or self._listing[0] is not specs:
+                summaries = []
+                for spec in sorted(specs.values(), key=lambda spec: spec.model_name):
+                    if not spec.public:
+                        continue
+                    pre_config = merge_configs(PreprocessingConfig(), spec.pre_config)
+                    summaries.append(ModelSummary(model_name=spec.model_name,
+                                                  property=spec.property,
+                                                  output_labels=spec.output_labels,
+                                                  allow_encoding=spec.allow_encoding,
+                                                  seq_len=pre_config.seq_len,
+                                                  vocab=pre_config.vocab,
+                                                  version=spec.version,
+                                                  versions=sorted(
+                                                      (version for version
+                                                       in self._versions.get(spec.model_name, {})
+                                                       if version is not None),
+                                                      key=version_key
+                                                  )))
+                self._listing = (specs, summaries)
+
+            return self._listing[1]
+
+_spec_index = None
+
+def get_spec_index():
+    global _spec_index
+    if _spec_index is None:
+        _spec_index = SpecIndex(get_app_config()["spec_refresh"])
+
+    return _spec_index
+
+def get_model_info():
+    return get_spec_index().get()
+
+def _is_known_model(model_name):
+    return get_spec_index().lookup(model_name) is not None
+
+set_model_filter(_is_known_model)
+
@@ -0,0 +1,67 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextvars import copy_context
+from functools import partial
+from threading import Lock
+from fastapi import HTTPException
+from .config import get_app_config
+from .metrics import collect_timings, replay_timings
+from .admission import current_deadline, deadline_scope
+
+_executor = None
+_executor_lock = Lock()
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            app_config = get_app_config()
+            if app_config["executor_kind"] == "process":
+                # Spawn so children never inherit an initialized TF runtime
+                _executor = ProcessPoolExecutor(
+                    max_workers=app_config["executor_workers"],
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                _executor = ThreadPoolExecutor(
+                    max_workers=app_config["executor_workers"],
+                    thread_name_prefix="deeppep"
+                )
+
+    return _executor
+
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+def _call_catching_http_errors(fn, args, kwargs, deadline=None):
+    # HTTPException does not survive pickling, so ship its fields instead,
+    # along with the stage timings recorded in the child
+    with collect_timings() as timings, deadline_scope(deadline):
+        try:
+            return None, fn(*args, **kwargs), timings
+        except HTTPException as err:
+            return (err.status_code, err.detail), None, timings
+
+async def run_in_executor(fn, *args, **kwargs):
+    executor = get_executor()
+    loop = asyncio.get_event_loop()
+    if not isinstance(executor, ProcessPoolExecutor):
+        # Run in a copy of the request's context so stage timings reach it
+        return await loop.run_in_executor(
+            executor, partial(copy_context().run, fn, *args, **kwargs)
+        )
+
+    error, result, timings = await loop.run_in_executor(
+        executor, partial(_call_catching_http_errors, fn, args, kwargs,
+                          current_deadline())
+    )
+    replay_timings(timings)
+    if error is not None:
+        raise HTTPException(status_code=error[0], detail=error[1])
+
+    return result
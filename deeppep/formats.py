@@ -0,0 +1,263 @@
+import gzip
+import io
+import numpy as np
+import orjson
+from fastapi import HTTPException, Response
+from fastapi.responses import JSONResponse
+
+NPY = "application/x-npy"
+ARROW = "application/vnd.apache.arrow.stream"
+MSGPACK = "application/msgpack"
+MSGPACK_LEGACY = "application/x-msgpack"
+TEXT = "text/plain"
+
+BINARY_MEDIA_TYPES = (NPY, ARROW, MSGPACK, MSGPACK_LEGACY)
+JSON_MEDIA_TYPES = ("application/json", "*/*")
+
+def _missing_dependency_message(media_type, package):
+    message = " ".join([
+        "FORMAT ERROR:",
+        "The media type {} requires the optional package {},",
+        "which is not installed on this server."
+        ]).format(media_type, package)
+
+    return message
+
+def _import_optional(name, media_type, status_code):
+    try:
+        return __import__(name)
+    except ImportError:
+        raise HTTPException(status_code = status_code,
+                            detail = _missing_dependency_message(media_type, name))
+
+def _media_types(header):
+    return [part.split(";")[0].strip().lower()
+            for part in (header or "").split(",") if part.strip()]
+
+def _accept_ranges(header):
+    """Media types of an Accept header with their q-values, in listed order."""
+    ranges = []
+    for part in (header or "").split(","):
+        fields = part.split(";")
+        media_type = fields[0].strip().lower()
+        if not media_type:
+            continue
+
+        q = 1.
+        for param in fields[1:]:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.
+        ranges.append((media_type, q))
+
+    return ranges
+
+def negotiate(accept):
+    """Pick the binary media type an Accept header prefers, or None for JSON.
+
+    Media types rank by q-value and then by the order they are listed in.
+    JSON is kept when application/json or */* ranks at or above every
+    binary type.
+    """
+    binary, json = None, None
+    for ind, (media_type, q) in enumerate(_accept_ranges(accept)):
+        if q <= 0:
+            continue
+
+        rank = (q, -ind)
+        if media_type in BINARY_MEDIA_TYPES:
+            if binary is None or rank > binary[0]:
+                binary = (rank, media_type)
+        elif media_type in JSON_MEDIA_TYPES:
+            json = rank if json is None else max(json, rank)
+
+    if binary is None or (json is not None and json >= binary[0]):
+        return None
+
+    return binary[1]
+
+##########
+# Output #
+##########
+
+def _to_npy(values, columns):
+    buffer = io.BytesIO()
+    np.save(buffer, values, allow_pickle=False)
+    return buffer.getvalue()
+
+def _to_arrow(values, columns):
+    pa = _import_optional("pyarrow", ARROW, 406)
+    if columns is not None and len(columns) == values.shape[1]:
+        arrays = [pa.array(values[:, ind]) for ind in range(values.shape[1])]
+        names = list(columns)
+    else:
+        flat = pa.array(values.reshape(-1))
+        arrays = [pa.FixedSizeListArray.from_arrays(flat, values.shape[1])]
+        names = ["values"]
+
+    batch = pa.RecordBatch.from_arrays(arrays, names=names)
+    sink = pa.BufferOutputStream()
+    writer = pa.ipc.new_stream(sink, batch.schema)
+    writer.write_batch(batch)
+    writer.close()
+
+    return sink.getvalue().to_pybytes()
+
+def _to_msgpack(values, columns):
+    msgpack = _import_optional("msgpack", MSGPACK, 406)
+    return msgpack.packb({"columns" : columns,
+                          "dtype" : values.dtype.str,
+                          "shape" : list(values.shape),
+                          "data" : values.tobytes()})
+
+_encoders = {
+    NPY : _to_npy,
+    ARROW : _to_arrow,
+    MSGPACK : _to_msgpack,
+    MSGPACK_LEGACY : _to_msgpack,
+}
+
+def encode_matrix(values, columns, media_type, dtype="float32"):
+    values = np.ascontiguousarray(values, dtype=dtype)
+    return _encoders[media_type](values, columns)
+
+def compress(body, accept_encoding, min_size=1024):
+    """Compress with zstd or gzip if the client accepts it.
+
+    Returns:
+        bytes: Possibly compressed body.
+        str: Content-Encoding to report, None if left uncompressed.
+    """
+    encodings = _media_types(accept_encoding)
+    if len(body) < min_size:
+        return body, None
+
+    if "zstd" in encodings:
+        try:
+            import zstandard
+            return zstandard.ZstdCompressor().compress(body), "zstd"
+        except ImportError:
+            pass
+
+    if "gzip" in encodings:
+        return gzip.compress(body, compresslevel=5), "gzip"
+
+    return body, None
+
+def matrix_response(values, columns, media_type, dtype="float32",
+                    accept_encoding=None, headers=None):
+    body = encode_matrix(values, columns, media_type, dtype)
+    body, content_encoding = compress(body, accept_encoding)
+
+    headers = dict(headers or {})
+    headers["X-Shape"] = ",".join(str(dim) for dim in values.shape)
+    headers["X-DType"] = np.dtype(dtype).str
+    if columns is not None:
+        headers["X-Columns"] = ",".join(columns)
+    if content_encoding is not None:
+        headers["Content-Encoding"] = content_encoding
+
+    return Response(content=body, media_type=media_type, headers=headers)
+
+class NumpyJSONResponse(JSONResponse):
+    """JSON response rendered by orjson, which writes NumPy arrays natively."""
+    def render(self, content):
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+
+def columnar_content(sequences, charges, values, columns):
+    content = {"sequence" : sequences}
+    if charges:
+        content["charge"] = charges
+
+    if columns is not None and len(columns) == values.shape[1]:
+        for ind, column in enumerate(columns):
+            content[column] = np.ascontiguousarray(values[:, ind])
+    else:
+        content["values"] = np.ascontiguousarray(values)
+
+    return content
+
+#########
+# Input #
+#########
+
+def _bad_body_message(media_type, error):
+    message = " ".join([
+        "FORMAT ERROR:",
+        "Could not read a sequence column from the {} body: {}"
+        ]).format(media_type, error)
+
+    return message
+
+def _from_npy(body):
+    array = np.load(io.BytesIO(body), allow_pickle=False)
+    if array.dtype.kind == "S":
+        array = np.char.decode(array)
+    if array.dtype.kind != "U":
+        raise ValueError("expected a string array, got {}".format(array.dtype))
+
+    return array.reshape(-1).tolist(), None
+
+def _from_arrow(body):
+    pa = _import_optional("pyarrow", ARROW, 415)
+    table = pa.ipc.open_stream(body).read_all()
+    return table.column("sequence").to_pylist(), None
+
+def _from_msgpack(body):
+    msgpack = _import_optional("msgpack", MSGPACK, 415)
+    payload = msgpack.unpackb(body, raw=False)
+    if isinstance(payload, dict):
+        return list(payload["sequences"]), payload.get("config")
+
+    return list(payload), None
+
+def _from_text(body):
+    return body.decode().split(), None
+
+_decoders = {
+    NPY : _from_npy,
+    ARROW : _from_arrow,
+    MSGPACK : _from_msgpack,
+    MSGPACK_LEGACY : _from_msgpack,
+    TEXT : _from_text,
+}
+
+def _unsupported_media_message(media_type):
+    message = " ".join([
+        "FORMAT ERROR:",
+        "Unsupported Content-Type {}.",
+        "Send one of: {}"
+        ]).format(media_type, ", ".join(_decoders))
+
+    return message
+
+def decode_sequences(body, content_type):
+    """Read the sequence column, and an optional user config, from a request body.
+
+    Returns:
+        List[str]: Sequences in request order.
+        dict: User config fields if the format carries them, otherwise None.
+    """
+    media_types = _media_types(content_type)
+    media_type = media_types[0] if media_types else None
+    if media_type not in _decoders:
+        raise HTTPException(status_code = 415,
+                            detail = _unsupported_media_message(media_type))
+
+    try:
+        sequences, config = _decoders[media_type](body)
+    except HTTPException:
+        raise
+    except Exception as err:
+        raise HTTPException(status_code = 400,
+                            detail = _bad_body_message(media_type, err))
+
+    if not all(isinstance(seq, str) for seq in sequences):
+        raise HTTPException(status_code = 400,
+                            detail = _bad_body_message(media_type,
+                                                       "sequences must be strings"))
+
+    return sequences, config
@@ -0,0 +1,158 @@
+import csv
+import re
+import numpy as np
+from fastapi import HTTPException
+from .types import InputFormat
+
+_content_types = {
+    "text/csv" : InputFormat.csv,
+    "application/csv" : InputFormat.csv,
+    "text/tab-separated-values" : InputFormat.tsv,
+    "text/plain" : InputFormat.txt,
+    "text/x-fasta" : InputFormat.fasta,
+    "application/x-fasta" : InputFormat.fasta,
+}
+
+_suffixes = {
+    ".csv" : InputFormat.csv,
+    ".tsv" : InputFormat.tsv,
+    ".txt" : InputFormat.txt,
+    ".fasta" : InputFormat.fasta,
+    ".fa" : InputFormat.fasta,
+}
+
+def _bad_input_message(line_number, error):
+    message = " ".join([
+        "INPUT ERROR:",
+        "Could not read line {}: {}"
+        ]).format(line_number, error)
+
+    return message
+
+def _unknown_format_message(source):
+    message = " ".join([
+        "INPUT ERROR:",
+        "Could not tell the input format from {}.",
+        "Use one of: {}"
+        ]).format(source, ", ".join(fmt.value for fmt in InputFormat))
+
+    return message
+
+def guess_format(content_type=None, filename=None):
+    """Input format from a Content-Type header or a file name."""
+    if content_type:
+        media_type = content_type.split(";")[0].strip().lower()
+        if media_type in _content_types:
+            return _content_types[media_type]
+
+    if filename:
+        for suffix, fmt in _suffixes.items():
+            if filename.lower().endswith(suffix):
+                return fmt
+
+    raise HTTPException(status_code = 415,
+                        detail = _unknown_format_message(
+                            filename or content_type
+                            ))
+
+def _read_table(lines, delimiter):
+    reader = csv.reader(lines, delimiter=delimiter)
+    header = [name.strip().lower() for name in next(reader, [])]
+    if "sequence" not in header:
+        raise HTTPException(status_code = 400,
+                            detail = _bad_input_message(
+                                1, "the header has no sequence column"
+                                ))
+    seq_ind = header.index("sequence")
+    charge_ind = header.index("charge") if "charge" in header else None
+
+    for line_number, row in enumerate(reader, 2):
+        if not row:
+            continue
+
+        try:
+            charge = int(row[charge_ind]) if charge_ind is not None else None
+            yield row[seq_ind].strip(), charge
+        except (IndexError, ValueError) as err:
+            raise HTTPException(status_code = 400,
+                                detail = _bad_input_message(line_number, err))
+
+def _read_text(lines):
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield line, None
+
+_cleavage_site = re.compile(r"(?<=[KR])(?!P)")
+
+def digest(protein, missed_cleavages=0, min_length=7, max_length=50):
+    """Tryptic peptides of a protein sequence, cutting after K/R but not before P."""
+    pieces = [piece for piece in _cleavage_site.split(protein) if piece]
+    for start in range(len(pieces)):
+        peptide = ""
+        for end in range(start, min(start + missed_cleavages + 1, len(pieces))):
+            peptide += pieces[end]
+            if len(peptide) > max_length:
+                break
+            if len(peptide) >= min_length:
+                yield peptide
+
+def _iter_proteins(lines):
+    protein = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith(">"):
+            if protein:
+                yield "".join(protein)
+            protein = []
+        elif line:
+            protein.append(line.upper())
+
+    if protein:
+        yield "".join(protein)
+
+def _read_fasta(lines, **digest_args):
+    # Proteins share many peptides, so only the first occurrence is kept
+    seen = set()
+    for protein in _iter_proteins(lines):
+        for sequence in digest(protein, **digest_args):
+            if sequence not in seen:
+                seen.add(sequence)
+                yield sequence, None
+
+def read_peptides(lines, fmt, **digest_args):
+    """Iterate over (sequence, charge) pairs from lines of text.
+
+    Charges are None unless a table has a charge column. FASTA input is
+    digested with trypsin, and `digest_args` are passed on to `digest`.
+    """
+    fmt = InputFormat(fmt)
+    if fmt == InputFormat.csv:
+        return _read_table(lines, ",")
+    if fmt == InputFormat.tsv:
+        return _read_table(lines, "\t")
+    if fmt == InputFormat.fasta:
+        return _read_fasta(lines, **digest_args)
+
+    return _read_text(lines)
+
+##########
+# Output #
+##########
+
+def output_columns(model_name, labels, width):
+    """Column names of one model's output, prefixed with the model name."""
+    if labels is None or len(labels) != width:
+        labels = [str(ind) for ind in range(width)]
+
+    return ["{}.{}".format(model_name, label) for label in labels]
+
+def format_rows(sequences, charges, values):
+    """CSV rows of peptides followed by their outputs."""
+    # Nine significant digits round trip float32 exactly
+    values = np.char.mod("%.9g", values).tolist()
+    if charges is None:
+        return ([seq] + row for seq, row in zip(sequences, values))
+
+    return ([seq, charge] + row
+            for seq, charge, row in zip(sequences, charges, values))
@@ -0,0 +1,73 @@
+import os
+import shutil
+import threading
+from fastapi import HTTPException
+from ..config import get_app_config
+from ..io import read_peptides
+from .store import JobStore
+from .runner import JobRunner
+
+_store = None
+_runner = None
+_jobs_lock = threading.Lock()
+
+def get_job_store():
+    global _store
+    with _jobs_lock:
+        if _store is None:
+            _store = JobStore(get_app_config()["jobs_dir"])
+
+    return _store
+
+def get_job_runner():
+    global _runner
+    store = get_job_store()
+    with _jobs_lock:
+        if _runner is None:
+            app_config = get_app_config()
+            _runner = JobRunner(store,
+                                max_active=app_config["max_active_jobs"],
+                                workers=app_config["job_workers"],
+                                tf_threads=app_config["job_tf_threads"])
+
+    return _runner
+
+def _empty_job_message():
+    message = " ".join([
+        "INPUT ERROR:",
+        "No peptides were found in the submitted file."
+        ])
+
+    return message
+
+def _bad_encoding_message(error):
+    message = " ".join([
+        "INPUT ERROR:",
+        "The submitted file is not UTF-8 text: {}"
+        ]).format(error)
+
+    return message
+
+def prepare_job(job_id, upload_path, fmt, models, action, **digest_args):
+    """Split an uploaded peptide file into chunks and queue the job."""
+    store = get_job_store()
+    try:
+        with open(upload_path, "r", encoding="utf-8", newline="") as handle:
+            peptides = read_peptides(handle, fmt, **digest_args)
+            rows, chunks = store.write_input(job_id,
+                                             peptides,
+                                             get_app_config()["job_chunk_size"])
+        if rows == 0:
+            raise HTTPException(status_code = 400,
+                                detail = _empty_job_message())
+        os.remove(upload_path)
+    except UnicodeDecodeError as err:
+        shutil.rmtree(store.job_dir(job_id), ignore_errors=True)
+        raise HTTPException(status_code = 400,
+                            detail = _bad_encoding_message(err))
+    except BaseException:
+        shutil.rmtree(store.job_dir(job_id), ignore_errors=True)
+        raise
+
+    store.create(job_id, models, action, rows, chunks)
+    return store.info(job_id)
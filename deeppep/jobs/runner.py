@@ -0,0 +1,158 @@
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from uuid import uuid4
+from ..types import JobState
+from .worker import init_worker, process_chunk
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class JobRunner:
+    """Claims jobs from a `JobStore` and works through their chunks.
+
+    A dispatcher thread polls the store and runs each claimed job in its
+    own thread, which feeds chunks to a pool of spawned processes. Each
+    process builds the models it needs once and keeps them for later
+    chunks. The pool is created on the first job, and the store's lease
+    count caps the jobs running across every server process at once.
+
+    """
+    niceness = 10
+
+    def __init__(self, store, max_active=1, workers=1, tf_threads=1,
+                 lease_seconds=60., poll_interval=2.):
+        self.store = store
+        self.max_active = max_active
+        self.workers = workers
+        self.tf_threads = tf_threads
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.owner = "{}:{}:{}".format(socket.gethostname(), os.getpid(),
+                                       uuid4().hex[:8])
+
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._jobs = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_worker,
+                    initargs=(self.niceness, self.tf_threads)
+                )
+
+            return self._pool
+
+    def _reset_pool(self, pool):
+        with self._pool_lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._dispatch,
+                                            name="deeppep-jobs",
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for thread in list(self._jobs.values()):
+            thread.join()
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+                self._pool = None
+
+    def _dispatch(self):
+        while not self._stop.is_set():
+            self._jobs = {job_id : thread for job_id, thread in self._jobs.items()
+                          if thread.is_alive()}
+            job_id = None
+            if len(self._jobs) < self.max_active:
+                try:
+                    job_id = self.store.claim(self.owner,
+                                              self.lease_seconds,
+                                              self.max_active)
+                except Exception:
+                    logger.exception("Could not poll the job store")
+
+            if job_id is not None:
+                thread = threading.Thread(target=self._run_job,
+                                          args=(job_id,),
+                                          name="deeppep-job-" + job_id,
+                                          daemon=True)
+                self._jobs[job_id] = thread
+                thread.start()
+            else:
+                self._stop.wait(self.poll_interval)
+
+    def _run_job(self, job_id):
+        logger.info("Starting job %s", job_id)
+        pool = self._get_pool()
+        try:
+            self._process(job_id, pool)
+        except BrokenProcessPool:
+            # A worker died, most likely out of memory, start fresh next time
+            self._reset_pool(pool)
+            self.store.finish(job_id, self.owner, JobState.failed,
+                              "A job worker exited unexpectedly")
+        except Exception as err:
+            logger.exception("Job %s failed", job_id)
+            self.store.finish(job_id, self.owner, JobState.failed, str(err))
+
+    def _process(self, job_id, pool):
+        info = self.store.info(job_id)
+        done = self.store.done_chunks(job_id)
+        pending = [chunk for chunk in range(info.chunks) if chunk not in done]
+
+        futures = {}
+        while pending or futures:
+            while pending and len(futures) < self.workers:
+                chunk = pending.pop(0)
+                future = pool.submit(process_chunk,
+                                     self.store.input_path(job_id, chunk),
+                                     self.store.output_path(job_id, chunk),
+                                     info.models,
+                                     info.action)
+                futures[future] = chunk
+
+            finished, _ = wait(futures,
+                               timeout=self.poll_interval,
+                               return_when=FIRST_COMPLETED)
+
+            if self._stop.is_set():
+                # Hand the job to whichever process starts next
+                self.store.release(job_id, self.owner)
+                return
+            if not self.store.renew(job_id, self.owner, self.lease_seconds):
+                logger.info("Job %s was deleted or taken over", job_id)
+                return
+
+            for future in finished:
+                chunk = futures.pop(future)
+                error = future.result()
+                if error is not None:
+                    for future in futures:
+                        future.cancel()
+                    self.store.finish(job_id, self.owner, JobState.failed, error)
+                    return
+
+                self.store.mark_chunk(job_id, chunk)
+
+        self.store.assemble_result(job_id, info.chunks)
+        self.store.finish(job_id, self.owner, JobState.done)
+        logger.info("Finished job %s", job_id)
@@ -0,0 +1,233 @@
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from ..types import Action, JobInfo, JobState
+
+
+class JobStore:
+    """SQLite backed queue of bulk jobs with their files under `root`.
+
+    Each job owns a directory holding its input split into chunk files and
+    one result file per finished chunk. A chunk is only recorded as done
+    once its result file is in place, so a job picked up again after a
+    restart skips straight to the first unfinished chunk.
+
+    Jobs are claimed with a lease which the owner renews while it works.
+    Every server process can therefore poll the same store, and a job whose
+    owner died becomes claimable again once its lease runs out.
+
+    """
+    def __init__(self, root):
+        self.root = root
+        self._local = threading.local()
+        os.makedirs(root, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " job_id TEXT PRIMARY KEY,"
+                " state TEXT NOT NULL,"
+                " models TEXT NOT NULL,"
+                " action TEXT NOT NULL,"
+                " rows INTEGER NOT NULL,"
+                " chunks INTEGER NOT NULL,"
+                " created REAL NOT NULL,"
+                " updated REAL NOT NULL,"
+                " error TEXT,"
+                " owner TEXT,"
+                " lease_expires REAL NOT NULL DEFAULT 0"
+                ")"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                " job_id TEXT NOT NULL,"
+                " chunk INTEGER NOT NULL,"
+                " PRIMARY KEY (job_id, chunk)"
+                ") WITHOUT ROWID"
+            )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.root, "jobs.sqlite"),
+                                   timeout=30,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+
+        return conn
+
+    #########
+    # Files #
+    #########
+
+    def job_dir(self, job_id):
+        return os.path.join(self.root, job_id)
+
+    def input_path(self, job_id, chunk):
+        return os.path.join(self.job_dir(job_id), "input_{:06d}.json".format(chunk))
+
+    def output_path(self, job_id, chunk):
+        return os.path.join(self.job_dir(job_id), "output_{:06d}.csv".format(chunk))
+
+    def result_path(self, job_id):
+        return os.path.join(self.job_dir(job_id), "result.csv")
+
+    def write_input(self, job_id, peptides, chunk_size):
+        """Split (sequence, charge) pairs into chunk files.
+
+        Returns:
+            int: Number of peptides written.
+            int: Number of chunks written.
+        """
+        rows, chunks = 0, 0
+        sequences, charges = [], []
+
+        def flush():
+            has_charges = any(charge is not None for charge in charges)
+            with open(self.input_path(job_id, chunks), "w") as handle:
+                json.dump({"sequences" : sequences,
+                           "charges" : charges if has_charges else None},
+                          handle)
+
+        for sequence, charge in peptides:
+            sequences.append(sequence)
+            charges.append(charge)
+            if len(sequences) == chunk_size:
+                flush()
+                rows, chunks = rows + len(sequences), chunks + 1
+                sequences, charges = [], []
+
+        if sequences:
+            flush()
+            rows, chunks = rows + len(sequences), chunks + 1
+
+        return rows, chunks
+
+    def assemble_result(self, job_id, chunks):
+        # Every chunk file repeats the header, keep only the first one
+        path = self.result_path(job_id)
+        with open(path + ".tmp", "wb") as result:
+            for chunk in range(chunks):
+                with open(self.output_path(job_id, chunk), "rb") as handle:
+                    if chunk > 0:
+                        handle.readline()
+                    shutil.copyfileobj(handle, result)
+
+        os.replace(path + ".tmp", path)
+        for chunk in range(chunks):
+            os.remove(self.input_path(job_id, chunk))
+            os.remove(self.output_path(job_id, chunk))
+
+    #########
+    # Queue #
+    #########
+
+    def create(self, job_id, models, action, rows, chunks):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO jobs (job_id, state, models, action, rows, chunks,"
+                " created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, JobState.queued.value, json.dumps(models), Action(action).value,
+                 rows, chunks, now, now)
+            )
+
+    def info(self, job_id):
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT job_id, state, models, action, rows, chunks, created,"
+            " updated, error, (SELECT COUNT(*) FROM chunks WHERE job_id = ?)"
+            " FROM jobs WHERE job_id = ?",
+            (job_id, job_id)
+        ).fetchone()
+        if row is None:
+            return None
+
+        return JobInfo(job_id=row[0], state=row[1], models=json.loads(row[2]),
+                       action=row[3], rows=row[4], chunks=row[5],
+                       created=row[6], updated=row[7], error=row[8],
+                       chunks_done=row[9])
+
+    def claim(self, owner, lease_seconds, max_active):
+        """Take the oldest claimable job unless `max_active` jobs are leased."""
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            active, = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE state = ? AND lease_expires > ?",
+                (JobState.running.value, now)
+            ).fetchone()
+            row = None
+            if active < max_active:
+                row = conn.execute(
+                    "SELECT job_id FROM jobs WHERE state = ?"
+                    " OR (state = ? AND lease_expires <= ?)"
+                    " ORDER BY created LIMIT 1",
+                    (JobState.queued.value, JobState.running.value, now)
+                ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET state = ?, owner = ?, lease_expires = ?,"
+                    " updated = ? WHERE job_id = ?",
+                    (JobState.running.value, owner, now + lease_seconds, now, row[0])
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        return row[0] if row is not None else None
+
+    def renew(self, job_id, owner, lease_seconds):
+        """Extend a lease, False if the job was deleted or taken over."""
+        now = time.time()
+        with self._connection() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires = ?, updated = ?"
+                " WHERE job_id = ? AND owner = ? AND state = ?",
+                (now + lease_seconds, now, job_id, owner, JobState.running.value)
+            )
+
+        return cursor.rowcount == 1
+
+    def release(self, job_id, owner):
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET lease_expires = 0 WHERE job_id = ? AND owner = ?",
+                (job_id, owner)
+            )
+
+    def done_chunks(self, job_id):
+        rows = self._connection().execute(
+            "SELECT chunk FROM chunks WHERE job_id = ?", (job_id,)
+        )
+        return {row[0] for row in rows}
+
+    def mark_chunk(self, job_id, chunk):
+        with self._connection() as conn:
+            conn.execute("INSERT OR IGNORE INTO chunks VALUES (?, ?)",
+                         (job_id, chunk))
+
+    def finish(self, job_id, owner, state, error=None):
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, updated = ?,"
+                " lease_expires = 0 WHERE job_id = ? AND owner = ?",
+                (JobState(state).value, error, time.time(), job_id, owner)
+            )
+
+    def delete(self, job_id):
+        with self._connection() as conn:
+            cursor = conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+            conn.execute("DELETE FROM chunks WHERE job_id = ?", (job_id,))
+
+        # Only known IDs may name a directory to remove
+        if cursor.rowcount != 1:
+            return False
+
+        shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+        return True
@@ -0,0 +1,55 @@
+import csv
+import json
+import os
+import numpy as np
+from fastapi import HTTPException
+from ..io import output_columns, format_rows
+from ..manager import compute_pipeline
+
+def init_worker(niceness, tf_threads):
+    """Run in each job process before it takes any work."""
+    # Yield the CPU to interactive requests served by the parent
+    os.nice(niceness)
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(tf_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+def _job_error_message(model_name, detail):
+    message = " ".join([
+        "JOB ERROR:",
+        "Model {} failed: {}"
+        ]).format(model_name, detail)
+
+    return message
+
+def process_chunk(input_path, output_path, models, action):
+    """Run every model on one input chunk and write the rows to a CSV file.
+
+    Returns:
+        str: Error message if a model rejected the chunk, otherwise None.
+    """
+    with open(input_path, "r") as handle:
+        chunk = json.load(handle)
+
+    sequences, charges = chunk["sequences"], chunk["charges"]
+    header = ["sequence"] if charges is None else ["sequence", "charge"]
+
+    blocks = []
+    for model_name in models:
+        try:
+            values, labels, _ = compute_pipeline(model_name, None, sequences, action)
+        except HTTPException as err:
+            return _job_error_message(model_name, err.detail)
+
+        header.extend(output_columns(model_name, labels, values.shape[1]))
+        blocks.append(values)
+
+    with open(output_path + ".tmp", "w", newline="") as handle:
+        writer = csv.writer(handle)
+        writer.writerow(header)
+        writer.writerows(format_rows(sequences, charges, np.hstack(blocks)))
+
+    # Only a complete file may ever appear under the final name
+    os.replace(output_path + ".tmp", output_path)
+    return None
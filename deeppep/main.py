@@ -1,6 +1,26 @@
-from fastapi import FastAPI, Path, Query, Body
-from .manager import PipelineManager
+import os
+import shutil
+from contextvars import copy_context
+from uuid import uuid4
+from fastapi import FastAPI, HTTPException, Path, Query, Body, Header, Request, Response
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
+from pydantic import ValidationError
+from starlette.concurrency import run_in_threadpool
+from .admission import DeadlineMiddleware, admit
+from .bundles import get_bundle, bundle_name, bundle_response
+from .config import get_app_config, get_spec_index
+from .executor import run_in_executor, shutdown_executor
+from .formats import NPY, negotiate, decode_sequences, matrix_response
+from .formats import NumpyJSONResponse, columnar_content
+from .io import guess_format
+from .jobs import get_job_store, get_job_runner, prepare_job
+from .manager import PipelineManager, run_pipeline, compute_pipeline
+from .manager import run_multi_pipeline, unique_model_names
+from .metrics import MetricsMiddleware, render, timed
+from .streaming import stream_pipeline
 from .types import *
+from .warmup import get_warm_up
+from .rollout import get_rollout
 
 app = FastAPI(
         title="Deep Peptide Server",
@@ -8,12 +28,101 @@ app = FastAPI(
                     " deep models of peptide properties",
         version="0.1.0",
         openapi_tags=[
+            {"name": "server",
+             "description": "Health of the server process."},
             {"name": "models",
              "description": "Operations to utilize models on sets of peptides"
-                            " and download models locally."}
+                            " and download models locally."},
+            {"name": "jobs",
+             "description": "Bulk predictions run in the background on"
+                            " uploaded peptide files."}
         ]   
         )
 
+app.add_middleware(DeadlineMiddleware)
+app.add_middleware(MetricsMiddleware,
+                   server_timing=get_app_config()["server_timing"])
+
+@app.on_event("startup")
+def start_warm_up():
+    get_warm_up().start()
+
+@app.on_event("startup")
+def start_rollout():
+    if get_app_config()["rollout"]:
+        get_rollout().start()
+
+@app.on_event("startup")
+def start_job_runner():
+    if get_app_config()["max_active_jobs"] > 0:
+        get_job_runner().start()
+
+@app.on_event("shutdown")
+def stop_executor():
+    shutdown_executor()
+
+@app.on_event("shutdown")
+def stop_rollout():
+    if get_app_config()["rollout"]:
+        get_rollout().stop()
+
+@app.on_event("shutdown")
+def stop_job_runner():
+    if get_app_config()["max_active_jobs"] > 0:
+        get_job_runner().stop()
+
+@app.get("/ready",
+         tags=["server"])
+async def get_readiness():
+    """Report whether this worker has finished warming up its models.
+
+    Returns 503 until models listed in DEEPPEP_PRELOAD_MODELS are loaded
+    and have run once, and 200 straight away if nothing is preloaded.
+    """
+    warm_up = get_warm_up()
+    return JSONResponse(status_code=200 if warm_up.ready else 503,
+                        content=warm_up.status())
+
+@app.get("/metrics",
+         tags=["server"],
+         response_class=PlainTextResponse)
+async def get_metrics():
+    """Report this worker's metrics in the Prometheus text format.
+
+    Covers request latency, time spent per stage and model, peptides
+    processed, and the state of the caches and loaded models.
+    """
+    return PlainTextResponse(render(),
+                             media_type="text/plain; version=0.0.4")
+
+def _stats_headers(stats):
+    return {"X-Rows" : str(stats["rows"]),
+            "X-Unique-Rows" : str(stats["unique_rows"])}
+
+def _serialize(build, *args, **kwargs):
+    with timed("serialize"):
+        return build(*args, **kwargs)
+
+async def _respond(build, *args, **kwargs):
+    """Build a response in the threadpool, timing it as the serialize stage."""
+    return await run_in_threadpool(copy_context().run, _serialize,
+                                   build, *args, **kwargs)
+
+async def _binary_response(model_name, user_config, sequences, action,
+                           media_type, dtype, accept_encoding, layer=None):
+    async with admit(model_name, len(sequences)):
+        values, labels, stats = await run_in_executor(compute_pipeline,
+                                                      model_name,
+                                                      user_config,
+                                                      sequences,
+                                                      action,
+                                                      layer)
+    return await _respond(matrix_response,
+                          values, labels, media_type,
+                          dtype=dtype.value,
+                          accept_encoding=accept_encoding,
+                          headers=_stats_headers(stats))
+
 @app.options("/models", 
              tags=["models"])
 async def get_prediction_api_options(
@@ -23,17 +132,78 @@ async def get_prediction_api_options(
                     " options to models that predict that property."
         )
     ):
-    return {}
+    """List the public models, optionally only those predicting one property."""
+    models = get_spec_index().listing()
+    if peptide_property is not None:
+        models = [summary for summary in models
+                  if summary.property == peptide_property.value]
+
+    return {"models" : models}
+
+@app.post("/models/reload",
+          tags=["models"])
+async def reload_model_specs():
+    model_info = get_spec_index().reload()
+    return {"models" : sorted(model_info.keys())}
+
+@app.post("/models/{action}",
+          tags=["models"])
+async def post_peptides_to_models(
+    action: Action = Path(
+        ..., title="Action to Perform",
+        description="Specify whether to return predictions or encodings of sequences"
+        ),
+    model_input: MultiModelInput = Body(
+        ..., title="Input For Several Models",
+        example={
+            "models": ["standard_rt", "standard_charge"],
+            "peptides": [
+                {"sequence" : "PEPTIDEK", "charge" : 2},
+            ],
+            "config": {"vocab" : {"M<ox>" : 23}}
+            }
+        )
+    ):
+    """Run several models on one list of peptides.
+
+    Outputs are merged per peptide and keyed by model, e.g. "standard_rt.rt",
+    or "standard_rt.values" for encodings. Models sharing a preprocessing
+    config tokenize the peptides once between them.
+    """
+    model_names = unique_model_names(model_input.models)
+    async with admit(model_names,
+                     len(model_input.peptides) * len(model_names)):
+        output, stats = await run_in_executor(run_multi_pipeline,
+                                              model_input.models,
+                                              model_input.config,
+                                              model_input.peptides,
+                                              action)
+    return await _respond(JSONResponse, output, headers=_stats_headers(stats))
 
 @app.get("/models/{model_name}",
-         tags=["models"])
+         tags=["models"],
+         response_class=FileResponse)
 async def get_model(
     model_name: str = Path(
         ..., title="Model Name",
         description="Name of model to download."
-        )
+        ),
+    range: Optional[str] = Header(None),
+    if_range: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None)
     ):
-    return {}
+    """Download a public model as a zip of its spec, config and weights.
+
+    Unzip the bundle into the directory named by DEEPPEP_MODEL_DIR to serve
+    the model elsewhere. Responses carry an ETag, so clients can revalidate
+    with If-None-Match, and support single byte ranges for resuming.
+    """
+    spec, path, digest = await run_in_threadpool(get_bundle, model_name)
+    return bundle_response(path, digest,
+                           "{}.zip".format(bundle_name(spec)),
+                           range_header=range,
+                           if_none_match=if_none_match,
+                           if_range=if_range)
 
 @app.get("/models/{model_name}/preprocessor/config", 
         tags=["models"],
@@ -74,9 +244,372 @@ async def post_peptides_to_model(
             "config": {"pattern" : "[A-Zn][^A-Zn]*",
                        "vocab"   : {"M<ox>" : 23}}
             }
+        ),
+    dtype: OutputDType = Query(
+        OutputDType.float32, title="Output Float Type",
+        description="Float width of binary responses, ignored for JSON"
+        ),
+    layer: Optional[str] = Query(
+        None, title="Encoding Layer",
+        description="Layer name or index whose activations the encode action"
+                    " returns, by default the layer before the output"
+        ),
+    accept: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None)
+    ):
+    """Run a model on a list of peptides.
+
+    JSON is returned by default. Sending an Accept header of
+    application/x-npy, application/vnd.apache.arrow.stream or
+    application/msgpack returns the output matrix as one binary buffer,
+    with its columns listed in the X-Columns header.
+
+    Requests over DEEPPEP_MAX_REQUEST_ROWS peptides get a 413 and belong on
+    the /stream endpoint or /jobs. When the worker is saturated requests
+    wait briefly, then get a 429 or 503 with a Retry-After header. Work
+    still queued when the request's deadline passes is dropped with a 504.
+    """
+    media_type = negotiate(accept)
+    if media_type is not None:
+        return await _binary_response(model_name,
+                                      model_input.config,
+                                      [pep.sequence for pep in model_input.peptides],
+                                      action,
+                                      media_type,
+                                      dtype,
+                                      accept_encoding,
+                                      layer)
+
+    async with admit(model_name, len(model_input.peptides)):
+        output, stats = await run_in_executor(run_pipeline,
+                                              model_name,
+                                              model_input.config,
+                                              model_input.peptides,
+                                              action,
+                                              layer)
+    return await _respond(JSONResponse, output, headers=_stats_headers(stats))
+
+def _bad_config_message(error):
+    message = " ".join([
+        "CONFIG ERROR:",
+        "Could not read the preprocessing config sent with the body: {}"
+        ]).format(error)
+
+    return message
+
+@app.post("/models/{model_name}/{action}/binary",
+          tags=["models"])
+async def post_binary_peptides_to_model(
+    request: Request,
+    model_name: str = Path(
+        ..., title="Model Name",
+        description="Name of model to perform predictions with."
+        ),
+    action: Action = Path(
+        ..., title="Action to Perform",
+        description="Specify whether to return predictions or encodings of sequences"
+        ),
+    dtype: OutputDType = Query(
+        OutputDType.float32, title="Output Float Type",
+        description="Float width of the returned matrix"
+        ),
+    layer: Optional[str] = Query(
+        None, title="Encoding Layer",
+        description="Layer name or index whose activations the encode action"
+                    " returns, by default the layer before the output"
+        ),
+    content_type: Optional[str] = Header(None),
+    accept: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None)
+    ):
+    """Run a model on a sequence column sent in a binary body.
+
+    The body may be a NumPy string array (application/x-npy), an Arrow
+    stream with a "sequence" column, a msgpack list or {"sequences": [...],
+    "config": {...}} map, or newline separated text/plain. The response
+    format follows the Accept header and defaults to the request's own
+    binary format, or .npy for text.
+    """
+    # Parsing a large body would hold up every request on the event loop
+    sequences, config = await run_in_threadpool(decode_sequences,
+                                                await request.body(),
+                                                content_type)
+    try:
+        user_config = UserConfig(**config) if config else None
+    except (TypeError, ValidationError) as err:
+        raise HTTPException(status_code = 400,
+                            detail = _bad_config_message(err))
+
+    media_type = negotiate(accept) or negotiate(content_type) or NPY
+    return await _binary_response(model_name,
+                                  user_config,
+                                  sequences,
+                                  action,
+                                  media_type,
+                                  dtype,
+                                  accept_encoding,
+                                  layer)
+
+
+@app.post("/models/{model_name}/{action}/stream",
+          tags=["models"])
+async def stream_peptides_to_model(
+    request: Request,
+    model_name: str = Path(
+        ..., title="Model Name",
+        description="Name of model to perform predictions with."
+        ),
+    action: Action = Path(
+        ..., title="Action to Perform",
+        description="Specify whether to return predictions or encodings of sequences"
+        )
+    ):
+    """Stream newline delimited peptides in and NDJSON results out.
+
+    Each line holds either a JSON peptide object, a JSON string or a bare
+    sequence. An optional first line of the form {"config": {...}} patches
+    the model's preprocessing defaults. Input is processed in fixed size
+    chunks, so memory use does not grow with the size of the submission.
+    """
+    return await stream_pipeline(model_name, action, request.stream())
+
+def _charge_length_message(n_sequences, n_charges):
+    message = " ".join([
+        "INPUT ERROR:",
+        "Received {} sequences but {} charges.",
+        "Charges must be omitted or given for every sequence."
+        ]).format(n_sequences, n_charges)
+
+    return message
+
+@app.post("/models/{model_name}/{action}/columnar",
+          tags=["models"],
+          response_class=NumpyJSONResponse)
+async def post_columnar_peptides_to_model(
+    model_name: str = Path(
+        ..., title="Model Name",
+        description="Name of model to perform predictions with."
+        ),
+    action: Action = Path(
+        ..., title="Action to Perform",
+        description="Specify whether to return predictions or encodings of sequences"
+        ),
+    model_input: PredictionInput = Body(
+        ..., title="Columnar Input For Models",
+        example={
+            "peptides": {"sequences" : ["PEPTIDEK", "SAM[16]PLER"],
+                         "charges" : [2, 3]},
+            "config": {"pattern" : "[A-Zn][^A-Zn]*",
+                       "vocab"   : {"M<ox>" : 23}}
+            }
+        ),
+    layer: Optional[str] = Query(
+        None, title="Encoding Layer",
+        description="Layer name or index whose activations the encode action"
+                    " returns, by default the layer before the output"
+        ),
+    ):
+    """Run a model on peptides given as column arrays.
+
+    Returns one array per output label, e.g. {"sequence": [...], "rt": [...]},
+    or a "values" matrix for encodings, without building an object per row.
+    """
+    sequences = model_input.peptides.sequences
+    charges = model_input.peptides.charges
+    if charges and len(charges) != len(sequences):
+        raise HTTPException(status_code = 400,
+                            detail = _charge_length_message(len(sequences),
+                                                            len(charges)))
+
+    user_config = None
+    if model_input.config is not None:
+        user_config = UserConfig(**model_input.config.dict(exclude_unset=True))
+
+    async with admit(model_name, len(sequences)):
+        values, labels, stats = await run_in_executor(compute_pipeline,
+                                                      model_name,
+                                                      user_config,
+                                                      sequences,
+                                                      action,
+                                                      layer)
+    content = columnar_content(sequences, charges, values, labels)
+    return await _respond(NumpyJSONResponse,
+                          content,
+                          headers=_stats_headers(stats))
+
+def _upload_too_large_message(max_mb):
+    message = " ".join([
+        "UPLOAD TOO LARGE:",
+        "Job uploads are limited to {:g} MB.",
+        "Split the peptides over several jobs."
+        ]).format(max_mb)
+
+    return message
+
+async def _spool_upload(stream, path, max_bytes, block_size=2**20):
+    # Blocks are gathered so each write to disk leaves the event loop once
+    size, buffer = 0, []
+    handle = await run_in_threadpool(open, path, "wb")
+    try:
+        async for block in stream:
+            size += len(block)
+            if max_bytes > 0 and size > max_bytes:
+                return False
+
+            buffer.append(block)
+            if sum(map(len, buffer)) >= block_size:
+                await run_in_threadpool(handle.write, b"".join(buffer))
+                buffer = []
+
+        await run_in_threadpool(handle.write, b"".join(buffer))
+        return True
+
+    finally:
+        await run_in_threadpool(handle.close)
+
+def _job_missing_message(job_id):
+    message = " ".join([
+        "Job Not Found:",
+        "The job, {}, does not exist or has been deleted."
+        ]).format(job_id)
+
+    return message
+
+def _job_unfinished_message(job_info):
+    message = " ".join([
+        "Job Not Finished:",
+        "The job, {}, is {} with {} of {} chunks done."
+        ]).format(job_info.job_id, job_info.state.value,
+                  job_info.chunks_done, job_info.chunks)
+
+    return message
+
+def _get_job_info(job_id):
+    job_info = get_job_store().info(job_id)
+    if job_info is None:
+        raise HTTPException(status_code = 404,
+                            detail = _job_missing_message(job_id))
+
+    return job_info
+
+@app.post("/jobs",
+          tags=["jobs"],
+          status_code=202,
+          response_model=JobInfo)
+async def submit_job(
+    request: Request,
+    models: List[str] = Query(
+        ..., title="Model Names",
+        description="Models to run on every peptide, repeat to give several."
+        ),
+    action: Action = Query(
+        Action.predict, title="Action to Perform",
+        description="Specify whether to return predictions or encodings of sequences"
+        ),
+    input_format: Optional[InputFormat] = Query(
+        None, alias="format", title="Input Format",
+        description="Format of the body, taken from Content-Type if not given"
+        ),
+    missed_cleavages: int = Query(
+        0, ge=0, title="Missed Cleavages",
+        description="Missed tryptic cleavages allowed when digesting FASTA input"
+        ),
+    min_length: int = Query(
+        7, ge=1, title="Minimum Length",
+        description="Shortest peptide kept when digesting FASTA input"
+        ),
+    max_length: int = Query(
+        50, ge=1, title="Maximum Length",
+        description="Longest peptide kept when digesting FASTA input"
+        ),
+    content_type: Optional[str] = Header(None),
+    content_length: Optional[int] = Header(None)
+    ):
+    """Queue a bulk job over an uploaded peptide file.
+
+    The body is a CSV or TSV table with a "sequence" column and an optional
+    "charge" column, plain text with one sequence per line, or a FASTA file
+    which is digested with trypsin. Poll /jobs/{job_id} for progress and
+    download the CSV from /jobs/{job_id}/result once the job is done.
+    Uploads over DEEPPEP_MAX_UPLOAD_MB get a 413.
+    """
+    fmt = input_format or guess_format(content_type)
+    for model_name in models:
+        PipelineManager(model_name).check_action(action)
+
+    max_mb = get_app_config()["max_upload_mb"]
+    max_bytes = int(max_mb * 2**20)
+    too_large = HTTPException(status_code = 413,
+                              detail = _upload_too_large_message(max_mb))
+    if max_bytes > 0 and content_length is not None and content_length > max_bytes:
+        raise too_large
+
+    job_id = uuid4().hex
+    job_dir = get_job_store().job_dir(job_id)
+    await run_in_threadpool(os.makedirs, job_dir)
+
+    # Spool the body to disk so large uploads never sit in memory, and
+    # leave nothing behind when an upload is refused or cut off
+    upload_path = os.path.join(job_dir, "upload")
+    try:
+        complete = await _spool_upload(request.stream(), upload_path, max_bytes)
+    except BaseException:
+        await run_in_threadpool(shutil.rmtree, job_dir, True)
+        raise
+    if not complete:
+        await run_in_threadpool(shutil.rmtree, job_dir, True)
+        raise too_large
+
+    return await run_in_threadpool(prepare_job,
+                                   job_id,
+                                   upload_path,
+                                   fmt,
+                                   models,
+                                   action,
+                                   missed_cleavages=missed_cleavages,
+                                   min_length=min_length,
+                                   max_length=max_length)
+
+@app.get("/jobs/{job_id}",
+         tags=["jobs"],
+         response_model=JobInfo)
+def get_job(
+    job_id: str = Path(
+        ..., title="Job ID",
+        description="ID returned when the job was submitted."
+        )
+    ):
+    return _get_job_info(job_id)
+
+@app.get("/jobs/{job_id}/result",
+         tags=["jobs"],
+         response_class=FileResponse)
+def get_job_result(
+    job_id: str = Path(
+        ..., title="Job ID",
+        description="ID returned when the job was submitted."
+        )
+    ):
+    job_info = _get_job_info(job_id)
+    if job_info.state != JobState.done:
+        raise HTTPException(status_code = 409,
+                            detail = _job_unfinished_message(job_info))
+
+    return FileResponse(get_job_store().result_path(job_id),
+                        media_type="text/csv",
+                        filename="{}.csv".format(job_id))
+
+@app.delete("/jobs/{job_id}",
+            tags=["jobs"])
+def delete_job(
+    job_id: str = Path(
+        ..., title="Job ID",
+        description="ID returned when the job was submitted."
         )
     ):
-    pipeline = PipelineManager(model_name, model_input.config)
-    output = pipeline.run(model_input.peptides, action)
-    return output
+    """Cancel a job if it is still running and remove its files."""
+    if not get_job_store().delete(job_id):
+        raise HTTPException(status_code = 404,
+                            detail = _job_missing_message(job_id))
 
+    return {"job_id" : job_id}
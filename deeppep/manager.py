@@ -1,21 +1,57 @@
+import threading
+import numpy as np
 from fastapi import HTTPException
-from .types import Action, PreprocessingConfig, merge_configs
-from .config import get_model_info
+from .types import Action, Backend, PreprocessingConfig, merge_configs
+from .config import get_app_config
+from .types import config_fingerprint, fingerprint
+from .io import output_columns
 from .preprocessing import PreprocessingManager
 from .prediction import PredictionManager
+from .prediction.cache import get_result_cache
+from .versions import get_versions
+from .metrics import histogram, counter, gauge, timed, Throughput
+
+DEDUP_RATIO = histogram("deeppep_dedup_ratio",
+                        "Fraction of request rows left after deduplication",
+                        buckets=(.1, .2, .3, .4, .5, .6, .7, .8, .9, 1.),
+                        labels=("model",))
+PEPTIDES = counter("deeppep_peptides_total",
+                   "Peptides run through a model",
+                   labels=("model", "action"))
+THROUGHPUT = Throughput()
+gauge("deeppep_peptides_per_second",
+      "Peptides run through any model per second, over the last minute",
+      fn=THROUGHPUT.rate)
+
+def _count_peptides(model_name, action, rows):
+    PEPTIDES.inc(rows, model=model_name, action=action.value)
+    THROUGHPUT.add(rows)
+
+def deduplicate(sequences):
+    # All rows share one effective config, so the sequence is the key
+    index = {}
+    inverse = np.fromiter(
+        (index.setdefault(seq, len(index)) for seq in sequences),
+        dtype=np.int64, count=len(sequences)
+    )
+
+    return list(index), inverse
 
 class PipelineManager:
-    def __init__(self, model_name, user_config=None):
-        self.model_name = model_name
-        self.model_config = self._get_model_config(self.model_name)
-        self.pre_config = PreprocessingConfig()
-        self.pre_config = merge_configs(self.pre_config,
-                                        self.model_config.pre_config
-                                       )
-        if user_config is not None:
-           self.pre_config = merge_configs(self.pre_config,
-                                           user_config
-                                           ) 
+    def __init__(self, model_name, user_config=None, layer=None):
+        with timed("pipeline_init", model_name):
+            self.model_name = model_name
+            self.layer = layer
+            self.model_config = self._get_model_config(self.model_name)
+            self.pre_config = PreprocessingConfig()
+            self.pre_config = merge_configs(self.pre_config,
+                                            self.model_config.pre_config
+                                           )
+            if user_config is not None:
+               self.pre_config = merge_configs(self.pre_config,
+                                               user_config
+                                               )
+        self.stats = {}
 
     def _model_missing_message(self, model_name):
         message = " ".join([
@@ -28,44 +64,72 @@ class PipelineManager:
         return message
 
     def _get_model_config(self, model_name):
-        model_info = get_model_info()
-        if not model_name in model_info:
+        model_config = get_versions().resolve(model_name)
+        if model_config is None:
             raise HTTPException(status_code = 404,
                                 detail = self._model_missing_message(model_name)
                                 )
 
-        return model_info[model_name]
+        return model_config
 
     def _check_encoding_permission(self):
         if not self.model_config.allow_encoding:
             raise HTTPException(status_code = 404,
                                 detail = "Resource's encodings are not available")
 
-    def _preprocess_peptides(self, peptides):
-        pre_manager = PreprocessingManager(**self.pre_config.dict())
-        peptides = pre_manager.preprocess(
-            [pep.sequence for pep in peptides]
-        )
+    def preprocessor(self):
+        return PreprocessingManager(**self.pre_config.dict())
+
+    def _finalize(self, ids):
+        pre_manager = self.preprocessor()
+
+        # Dense one hot encodings are expanded lazily to bound memory
+        if self.pre_config.one_hot:
+            return pre_manager.finalize_chunks(
+                ids, get_app_config()["one_hot_chunk_size"]
+            )
+
+        return [pre_manager.encoder.finalize(ids)]
+
+    def _preprocess_sequences(self, sequences):
+        with timed("preprocess", self.model_name):
+            ids = self.preprocessor().integer_encode(sequences)
+
+        return self._finalize(ids)
 
-        return peptides
+    def _run_chunks(self, fn, enc_chunks):
+        outputs = [fn(chunk) for chunk in enc_chunks]
+        if len(outputs) == 1:
+            return outputs[0]
 
-    def _predict(self, enc_peptides):
-        pred_manager = PredictionManager(model_name=self.model_name,
-                                         config_path=self.model_config.config_path,
-                                         weight_path=self.model_config.weight_path)
+        return np.concatenate(outputs)
 
-        predictions = pred_manager.predict(enc_peptides)
+    def prediction_manager(self):
+        return PredictionManager(model_name=self.model_name,
+                                 config_path=self.model_config.config_path,
+                                 weight_path=self.model_config.weight_path,
+                                 backend=self.model_config.backend,
+                                 quantize=self.model_config.quantize,
+                                 seq_len=self.pre_config.seq_len)
+
+    def _predict(self, enc_chunks):
+        pred_manager = self.prediction_manager()
+
+        predictions = self._run_chunks(pred_manager.predict, enc_chunks)
         return predictions
 
-    def _encode(self, enc_peptides):
-        pred_manager = PredictionManager(model_name=self.model_name,
-                                         config_path=self.model_config.config_path,
-                                         weight_path=self.model_config.weight_path)
+    def _encode(self, enc_chunks):
+        pred_manager = self.prediction_manager()
 
-        encodings = pred_manager.encode(enc_peptides)
+        encodings = self._run_chunks(lambda chunk: pred_manager.encode(chunk, self.layer),
+                                     enc_chunks)
         return encodings
 
     def _build_output(self, peptides, predictions, output_labels=None):
+        with timed("build_output", self.model_name):
+            return self._build_output_rows(peptides, predictions, output_labels)
+
+    def _build_output_rows(self, peptides, predictions, output_labels=None):
         if output_labels is None:
             output = [{"values" : pred} for pred in predictions.tolist()]
 
@@ -79,19 +143,229 @@ class PipelineManager:
         [item.update(pep.dict()) for pep, item in zip(peptides, output)]
         return output
 
-    def run(self, peptides, action):
-        enc_peptides = self._preprocess_peptides(peptides)
-          
+    def _infer_encoded(self, enc_chunks, action):
         if action == Action.predict:
-            predictions = self._predict(enc_peptides)
-            output = self._build_output(peptides, 
-                                        predictions, 
-                                        self.model_config.output_labels)
+            return self._predict(enc_chunks)
 
+        return self._encode(enc_chunks)
+
+    def _infer(self, sequences, action, encoding=None, inds=None):
+        # A shared encoding of all sequences spares tokenizing them again
+        if encoding is None:
+            if inds is not None:
+                sequences = [sequences[ind] for ind in inds]
+            enc_chunks = self._preprocess_sequences(sequences)
         else:
+            ids = encoding() if inds is None else encoding()[inds]
+            enc_chunks = self._finalize(ids)
+
+        return self._infer_encoded(enc_chunks, action)
+
+    def _cached_infer(self, sequences, action, encoding=None):
+        cache = get_result_cache()
+        if cache is None or not sequences:
+            return self._infer(sequences, action, encoding)
+
+        try:
+            namespace = cache.namespace(self.model_config.config_path,
+                                        self.model_config.weight_path,
+                                        config_fingerprint(self.pre_config),
+                                        self._cache_action(action),
+                                        self._cache_backend())
+        except OSError:
+            # Let the prediction manager report the missing model files
+            return self._infer(sequences, action, encoding)
+
+        rows = cache.get_many(namespace, sequences)
+        miss_inds = [ind for ind, row in enumerate(rows) if row is None]
+        if not miss_inds:
+            output = np.frombuffer(b"".join(rows), dtype=np.float32)
+            return output.reshape(len(rows), -1).copy()
+
+        misses = [sequences[ind] for ind in miss_inds]
+        miss_output = self._infer(sequences, action, encoding, miss_inds)
+        miss_output = miss_output.astype(np.float32, copy=False)
+        cache.put_many(namespace, misses, miss_output)
+        if len(miss_inds) == len(rows):
+            return miss_output
+
+        output = np.empty(shape=(len(rows), miss_output.shape[1]),
+                          dtype=np.float32)
+        output[miss_inds] = miss_output
+        hit_inds = [ind for ind, row in enumerate(rows) if row is not None]
+        hits = np.frombuffer(b"".join(rows[ind] for ind in hit_inds),
+                             dtype=np.float32)
+        output[hit_inds] = hits.reshape(len(hit_inds), -1)
+
+        return output
+
+    def _cache_backend(self):
+        # Converted and quantized models give slightly different outputs
+        return "{}:{}".format(Backend(self.model_config.backend).value,
+                              "int8" if self.model_config.quantize else "float")
+
+    def _cache_action(self, action):
+        # Activations of other layers must not answer for the default one
+        if action == Action.encode and self.layer is not None:
+            return "{}:{}".format(action, self.layer)
+
+        return action
+
+    def output_labels(self, action):
+        if action == Action.predict:
+            return self.model_config.output_labels
+
+        return None
+
+    def check_action(self, action):
+        if action != Action.predict:
             self._check_encoding_permission()
-            encodings = self._encode(enc_peptides) 
-            output = self._build_output(peptides, encodings)
+
+    def compute(self, sequences, action):
+        self.check_action(action)
+
+        unique, inverse = deduplicate(sequences)
+        self.stats["rows"] = len(sequences)
+        self.stats["unique_rows"] = len(unique)
+        if sequences:
+            DEDUP_RATIO.observe(len(unique) / len(sequences),
+                                model=self.model_name)
+
+        values = self._cached_infer(unique, action)
+        if len(unique) < len(sequences):
+            values = values[inverse]
+
+        _count_peptides(self.model_name, action, len(sequences))
+        return values
+
+    def run(self, peptides, action):
+        values = self.compute([pep.sequence for pep in peptides], action)
+        output = self._build_output(peptides,
+                                    values,
+                                    self.output_labels(action))
 
         return output
 
+
+def run_pipeline(model_name, user_config, peptides, action, layer=None):
+    pipeline = PipelineManager(model_name, user_config, layer)
+    output = pipeline.run(peptides, action)
+    return output, pipeline.stats
+
+def compute_pipeline(model_name, user_config, sequences, action, layer=None):
+    pipeline = PipelineManager(model_name, user_config, layer)
+    values = pipeline.compute(sequences, action)
+    return values, pipeline.output_labels(action), pipeline.stats
+
+
+class SharedEncoding:
+    """Integer encoding of a list of sequences, computed once on first use."""
+    def __init__(self, pre_manager, sequences, label=""):
+        self.pre_manager = pre_manager
+        self.sequences = sequences
+        self.label = label
+        self._ids = None
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            if self._ids is None:
+                with timed("preprocess", self.label):
+                    self._ids = self.pre_manager.integer_encode(self.sequences)
+
+        return self._ids
+
+
+def _no_models_message():
+    message = " ".join([
+        "INPUT ERROR:",
+        "At least one model name must be given."
+        ])
+
+    return message
+
+def unique_model_names(model_names):
+    """Model names of a multi-model request in order, without repeats."""
+    if not model_names:
+        raise HTTPException(status_code = 400,
+                            detail = _no_models_message())
+
+    return list(dict.fromkeys(model_names))
+
+def _joint_label(pipelines):
+    # Sorted so each set of models shares one label whatever the request order
+    return "+".join(sorted({pipeline.model_name for pipeline in pipelines}))
+
+class MultiPipelineManager:
+    """Runs several models on the same peptides.
+
+    Models whose effective preprocessing configs match form a group which
+    tokenizes the peptides once, and only if some model in the group misses
+    the result cache. Models then run one after another in the calling
+    thread, so a request holds one executor slot however many it names.
+
+    """
+    def __init__(self, model_names, user_config=None):
+        self.pipelines = [PipelineManager(model_name, user_config)
+                          for model_name in unique_model_names(model_names)]
+        self.stats = {}
+
+    def _groups(self):
+        groups = {}
+        for pipeline in self.pipelines:
+            key = fingerprint(**pipeline.pre_config.dict())
+            groups.setdefault(key, []).append(pipeline)
+
+        return list(groups.values())
+
+    def compute(self, sequences, action):
+        """Outputs of each model as (model name, values, output labels)."""
+        for pipeline in self.pipelines:
+            pipeline.check_action(action)
+
+        unique, inverse = deduplicate(sequences)
+        self.stats["rows"] = len(sequences)
+        self.stats["unique_rows"] = len(unique)
+
+        tasks = []
+        for group in self._groups():
+            encoding = SharedEncoding(group[0].preprocessor(), unique,
+                                      _joint_label(group))
+            tasks.extend((pipeline, encoding) for pipeline in group)
+
+        results = {pipeline.model_name : pipeline._cached_infer(unique, action, encoding)
+                   for pipeline, encoding in tasks}
+
+        output = []
+        for pipeline in self.pipelines:
+            values = results[pipeline.model_name]
+            if len(unique) < len(sequences):
+                values = values[inverse]
+            _count_peptides(pipeline.model_name, action, len(sequences))
+            output.append((pipeline.model_name, values, pipeline.output_labels(action)))
+
+        return output
+
+    def _build_output(self, peptides, blocks):
+        output = [{} for _ in peptides]
+        for model_name, values, labels in blocks:
+            if labels is None:
+                key = "{}.values".format(model_name)
+                [item.update({key : row}) for item, row in zip(output, values.tolist())]
+            else:
+                columns = output_columns(model_name, labels, values.shape[1])
+                [item.update(zip(columns, row)) for item, row in zip(output, values.tolist())]
+
+        [item.update(pep.dict()) for pep, item in zip(peptides, output)]
+        return output
+
+    def run(self, peptides, action):
+        blocks = self.compute([pep.sequence for pep in peptides], action)
+        with timed("build_output", _joint_label(self.pipelines)):
+            return self._build_output(peptides, blocks)
+
+
+def run_multi_pipeline(model_names, user_config, peptides, action):
+    pipeline = MultiPipelineManager(model_names, user_config)
+    output = pipeline.run(peptides, action)
+    return output, pipeline.stats
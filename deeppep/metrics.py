@@ -0,0 +1,340 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+
+    return "{" + ",".join('{}="{}"'.format(name, _escape(str(value)))
+                          for name, value in pairs) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def _sample_lines(self):
+        with self._lock:
+            return ["{}{} {}".format(self.name,
+                                     _format_labels(self.labels, key),
+                                     _format_value(value))
+                    for key, value in sorted(self._series.items())]
+
+    def render(self):
+        return ["# HELP {} {}".format(self.name, self.description),
+                "# TYPE {} {}".format(self.name, self.kind)] + self._sample_lines()
+
+
+class Counter(_Metric):
+    """Monotonic total split by label values."""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Value which goes up and down, or is read from `fn` at scrape time.
+
+    `fn` returns a number, None to leave the gauge out, or a dict mapping
+    tuples of label values to numbers.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, description, labels=(), fn=None):
+        super().__init__(name, description, labels)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._series[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def _sample_lines(self):
+        if self.fn is not None:
+            value = self.fn()
+            if value is None:
+                return []
+            series = value if isinstance(value, dict) else {() : value}
+            with self._lock:
+                self._series = dict(series)
+
+        return super()._sample_lines()
+
+
+class Histogram(_Metric):
+    """Cumulative histogram of observations split by label values."""
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets, labels=()):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0., 0]
+
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {}
+            for key, (counts, total, count) in self._series.items():
+                cumulative, running = [], 0
+                for bucket_count in counts:
+                    running += bucket_count
+                    cumulative.append(running)
+
+                snapshot[key] = {"buckets" : list(zip(self.buckets, cumulative)),
+                                 "sum" : total,
+                                 "count" : count}
+
+        return snapshot
+
+    def _sample_lines(self):
+        lines = []
+        for key, series in sorted(self.snapshot().items()):
+            for bucket, count in series["buckets"] + [(float("inf"), series["count"])]:
+                lines.append("{}_bucket{} {}".format(
+                    self.name,
+                    _format_labels(self.labels, key, [("le", _format_value(bucket))]),
+                    count
+                ))
+            labels = _format_labels(self.labels, key)
+            lines.append("{}_sum{} {}".format(self.name, labels, _format_value(series["sum"])))
+            lines.append("{}_count{} {}".format(self.name, labels, series["count"]))
+
+        return lines
+
+
+class Throughput:
+    """Events per second over a sliding window."""
+    def __init__(self, window=60.):
+        self.window = window
+        self._events = deque()
+        self._lock = threading.Lock()
+
+    def _trim(self, now):
+        while self._events and self._events[0][0] < now - self.window:
+            self._events.popleft()
+
+    def add(self, count):
+        now = time.monotonic()
+        with self._lock:
+            self._events.append((now, count))
+            self._trim(now)
+
+    def rate(self):
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            return sum(count for _, count in self._events) / self.window
+
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+def _register(name, build):
+    with _metrics_lock:
+        if name not in _metrics:
+            _metrics[name] = build()
+
+    return _metrics[name]
+
+def histogram(name, description, buckets=LATENCY_BUCKETS, labels=()):
+    return _register(name, lambda: Histogram(name, description, buckets, labels))
+
+def counter(name, description, labels=()):
+    return _register(name, lambda: Counter(name, description, labels))
+
+def gauge(name, description, labels=(), fn=None):
+    return _register(name, lambda: Gauge(name, description, labels, fn))
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    with _metrics_lock:
+        metrics = list(_metrics.values())
+
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+
+    return "\n".join(lines) + "\n"
+
+##########
+# Labels #
+##########
+
+# Set by the spec index, so that model names sent for models which do not
+# exist share one label value rather than each adding series for good
+_model_filter = None
+
+def set_model_filter(fn):
+    global _model_filter
+    _model_filter = fn
+
+def model_label(model_name):
+    """Label value for a model, or "+" joined models, "unknown" if any does not exist."""
+    if not model_name or _model_filter is None:
+        return model_name
+    if all(_model_filter(part) for part in model_name.split("+")):
+        return model_name
+
+    return "unknown"
+
+##########
+# Stages #
+##########
+
+STAGE_SECONDS = histogram("deeppep_stage_seconds",
+                          "Time spent in each stage of handling a request",
+                          labels=("stage", "model"))
+
+# Timings of the request being handled, if it collects them
+_request_timings = ContextVar("deeppep_request_timings", default=None)
+
+def record_stage(stage, seconds, model=""):
+    STAGE_SECONDS.observe(seconds, stage=stage, model=model_label(model))
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((stage, model, seconds))
+
+@contextmanager
+def timed(stage, model=""):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start, model)
+
+@contextmanager
+def collect_timings():
+    """Gather stage timings recorded in this context, and contexts copied from it."""
+    timings = []
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+def replay_timings(timings):
+    # Timings recorded in another process count as if recorded here
+    for stage, model, seconds in timings:
+        record_stage(stage, seconds, model)
+
+def server_timing(timings):
+    """Server-Timing header value, summing repeated stages of one model."""
+    totals = {}
+    for stage, model, seconds in timings:
+        totals[(stage, model)] = totals.get((stage, model), 0.) + seconds
+
+    return ", ".join(
+        "{};dur={:.3f}".format(stage, seconds * 1000)
+        + (';desc="{}"'.format(model) if model else "")
+        for (stage, model), seconds in totals.items()
+    )
+
+############
+# Requests #
+############
+
+IN_FLIGHT = gauge("deeppep_requests_in_flight",
+                  "Requests currently being handled by this worker")
+REQUEST_SECONDS = histogram("deeppep_request_seconds",
+                            "Time from receiving a request to finishing its response",
+                            labels=("handler", "model", "status"))
+
+
+class MetricsMiddleware:
+    """ASGI middleware counting requests in flight and timing whole requests.
+
+    Each request gets its own list of stage timings. With `server_timing`
+    set they are sent back in a Server-Timing header, covering the stages
+    finished by the time the response starts.
+
+    Every server worker keeps its own metrics, so /metrics describes only
+    the worker which answered the scrape.
+
+    """
+    def __init__(self, app, server_timing=False):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+        start = time.perf_counter()
+
+        with collect_timings() as timings:
+            async def send_with_timings(message):
+                if message["type"] == "http.response.start":
+                    status[0] = message["status"]
+                    if self.server_timing:
+                        header = server_timing(
+                            timings + [("total", "", time.perf_counter() - start)]
+                        )
+                        message = dict(message)
+                        message["headers"] = list(message.get("headers", [])) + [
+                            (b"server-timing", header.encode("latin-1"))
+                        ]
+                await send(message)
+
+            IN_FLIGHT.inc()
+            try:
+                await self.app(scope, receive, send_with_timings)
+            finally:
+                IN_FLIGHT.dec()
+                # The router fills in the matched endpoint and path parameters
+                endpoint = scope.get("endpoint")
+                REQUEST_SECONDS.observe(
+                    time.perf_counter() - start,
+                    handler=getattr(endpoint, "__name__", "unmatched"),
+                    model=model_label(scope.get("path_params", {}).get("model_name", "")),
+                    status=status[0]
+                )
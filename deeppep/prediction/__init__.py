@@ -1 +1,2 @@
 from .manager import PredictionManager
+from .registry import ModelRegistry, get_registry
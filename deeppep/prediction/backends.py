@@ -0,0 +1,143 @@
+import logging
+import os
+import threading
+import numpy as np
+import tensorflow as tf
+
+logger = logging.getLogger("uvicorn.error")
+
+# Rows per call into a compiled function or interpreter, bounding the
+# memory one large request can take
+CHUNK_SIZE = 1024
+
+def input_spec(model, seq_len=0):
+    """Signature of the model's input with a free batch dimension.
+
+    A positive `seq_len` from the model spec fixes the sequence length,
+    otherwise the model's own input shape is used.
+    """
+    shape = list(model.inputs[0].shape)
+    shape[0] = None
+    if seq_len > 0:
+        shape[1] = seq_len
+
+    return tf.TensorSpec(shape, model.inputs[0].dtype)
+
+def _chunked(fn, input, chunk_size=CHUNK_SIZE):
+    outputs = [fn(input[start:start + chunk_size])
+               for start in range(0, input.shape[0], chunk_size)]
+    if len(outputs) == 1:
+        return outputs[0]
+
+    return np.concatenate(outputs)
+
+
+class FunctionBackend:
+    """Model traced once into a graph function with a fixed input signature.
+
+    Skips the per call setup of Keras `predict`, which dominates the time
+    taken by small batches.
+    """
+    def __init__(self, model, seq_len=0, batch_size=CHUNK_SIZE):
+        self.batch_size = batch_size
+        self.spec = input_spec(model, seq_len)
+        self.function = tf.function(lambda input: model(input, training=False),
+                                    input_signature=[self.spec])
+        self.function.get_concrete_function()
+
+    def _predict(self, input):
+        return self.function(input).numpy()
+
+    def predict(self, input):
+        input = input.astype(self.spec.dtype.as_numpy_dtype, copy=False)
+        return _chunked(self._predict, input, self.batch_size)
+
+
+def convert_to_tflite(model, seq_len=0, quantize=False):
+    function = tf.function(lambda input: model(input, training=False),
+                           input_signature=[input_spec(model, seq_len)])
+    # TF 2.3, as pinned, takes only the functions here
+    converter = tf.lite.TFLiteConverter.from_concrete_functions(
+        [function.get_concrete_function()]
+    )
+    # Recurrent layers with a free batch dimension keep their TF list ops
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS,
+                                           tf.lite.OpsSet.SELECT_TF_OPS]
+    converter._experimental_lower_tensor_list_ops = False
+    if quantize:
+        # Dynamic range quantization: int8 weights, float activations
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    return converter.convert()
+
+def tflite_path(weight_path, seq_len=0, quantize=False):
+    """Where the converted model is kept, next to the weights it came from."""
+    stem = weight_path[:-len(".h5")] if weight_path.endswith(".h5") else weight_path
+    if stem.endswith(".weights"):
+        stem = stem[:-len(".weights")]
+
+    parts = [stem]
+    if seq_len > 0:
+        parts.append("len{}".format(seq_len))
+    if quantize:
+        parts.append("int8")
+
+    return ".".join(parts + ["tflite"])
+
+def load_tflite(model, sources, seq_len=0, quantize=False):
+    """Read a cached conversion, or convert and try to cache the result.
+
+    A cached file is used only if it is newer than every source file.
+    Model directories may be read only, in which case the conversion is
+    kept in memory for the life of the process.
+    """
+    path = tflite_path(sources[-1], seq_len, quantize)
+    try:
+        if os.path.getmtime(path) >= max(os.path.getmtime(source) for source in sources):
+            with open(path, "rb") as handle:
+                return handle.read()
+    except OSError:
+        pass
+
+    content = convert_to_tflite(model, seq_len, quantize)
+    try:
+        with open(path + ".tmp", "wb") as handle:
+            handle.write(content)
+        os.replace(path + ".tmp", path)
+    except OSError as err:
+        logger.warning("Could not cache converted model at %s: %s", path, err)
+
+    return content
+
+
+class TFLiteBackend:
+    """TFLite interpreter over a converted model.
+
+    An interpreter holds its tensors between calls, so calls are
+    serialized, and the input is only resized when the batch shape changes.
+    """
+    def __init__(self, content, threads=None):
+        self.interpreter = tf.lite.Interpreter(model_content=content,
+                                               num_threads=threads)
+        self.interpreter.allocate_tensors()
+        input_details = self.interpreter.get_input_details()[0]
+        self._input = input_details["index"]
+        self._dtype = input_details["dtype"]
+        self._output = self.interpreter.get_output_details()[0]["index"]
+        self._shape = None
+        self._lock = threading.Lock()
+
+    def _predict(self, input):
+        if input.shape != self._shape:
+            self.interpreter.resize_tensor_input(self._input, input.shape)
+            self.interpreter.allocate_tensors()
+            self._shape = input.shape
+
+        self.interpreter.set_tensor(self._input, input)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self._output).copy()
+
+    def predict(self, input):
+        input = np.ascontiguousarray(input, dtype=self._dtype)
+        with self._lock:
+            return _chunked(self._predict, input)
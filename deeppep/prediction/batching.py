@@ -0,0 +1,135 @@
+import threading
+import time
+import numpy as np
+from concurrent.futures import Future
+from ..config import get_app_config
+from ..metrics import histogram, SIZE_BUCKETS
+
+BATCH_SIZE = histogram("deeppep_batch_size",
+                       "Rows per coalesced forward pass",
+                       buckets=SIZE_BUCKETS,
+                       labels=("model",))
+QUEUE_WAIT = histogram("deeppep_batch_queue_wait_seconds",
+                       "Time requests wait before their batch runs",
+                       labels=("model",))
+
+
+class _PendingRequest:
+    def __init__(self, input):
+        self.input = input
+        self.rows = input.shape[0]
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+
+class MicroBatcher:
+    """Coalesce concurrent predictions against one model into shared batches.
+
+    There is no background thread. The first request to arrive while the
+    batcher is idle becomes the leader: it waits up to `max_wait` seconds
+    for other requests to queue rows, runs the forward pass for everything
+    gathered and hands every request its slice of the output. Once its own
+    request is answered it steps down, and a request still waiting takes
+    over, so no caller serves the queue indefinitely. Requests are never
+    split, so a single request larger than `max_batch_size` runs as its
+    own batch.
+
+    """
+    def __init__(self, name, max_batch_size, max_wait):
+        self.name = name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending = []
+        self._leading = False
+        self._cond = threading.Condition()
+
+    def _pending_rows(self):
+        return sum(request.rows for request in self._pending)
+
+    def _take_batch(self):
+        batch, rows = [], 0
+        while self._pending:
+            if batch and rows + self._pending[0].rows > self.max_batch_size:
+                break
+
+            request = self._pending.pop(0)
+            batch.append(request)
+            rows += request.rows
+
+        return batch
+
+    def _run_batch(self, batch, predict_fn):
+        start = time.perf_counter()
+        for request in batch:
+            QUEUE_WAIT.observe(start - request.enqueued, model=self.name)
+        BATCH_SIZE.observe(sum(request.rows for request in batch),
+                           model=self.name)
+
+        try:
+            output = predict_fn(
+                np.concatenate([request.input for request in batch])
+            )
+        except BaseException as err:
+            for request in batch:
+                request.future.set_exception(err)
+            if not isinstance(err, Exception):
+                raise
+            return
+
+        offset = 0
+        for request in batch:
+            request.future.set_result(output[offset:offset + request.rows])
+            offset += request.rows
+
+    def _lead(self, request, predict_fn):
+        deadline = time.perf_counter() + self.max_wait
+        with self._cond:
+            while self._pending_rows() < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+        # Batches are taken in arrival order, so the leader's own request
+        # is answered after a bounded number of them
+        while not request.future.done():
+            with self._cond:
+                batch = self._take_batch()
+
+            self._run_batch(batch, predict_fn)
+            with self._cond:
+                self._cond.notify_all()
+
+    def submit(self, input, predict_fn):
+        request = _PendingRequest(input)
+        with self._cond:
+            self._pending.append(request)
+            self._cond.notify_all()
+            while self._leading and not request.future.done():
+                self._cond.wait()
+
+            if request.future.done():
+                return request.future.result()
+            self._leading = True
+
+        try:
+            self._lead(request, predict_fn)
+        finally:
+            with self._cond:
+                self._leading = False
+                self._cond.notify_all()
+
+        return request.future.result()
+
+
+def get_batcher(name, loaded):
+    """Batcher of a loaded model, kept with it so both are freed together."""
+    app_config = get_app_config()
+    if app_config["batch_max_wait_ms"] <= 0:
+        return None
+
+    return loaded.derived("batcher", lambda model: MicroBatcher(
+        name,
+        max_batch_size=app_config["batch_max_size"],
+        max_wait=app_config["batch_max_wait_ms"] / 1000.
+    ))
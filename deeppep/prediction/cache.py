@@ -0,0 +1,214 @@
+import os
+import sqlite3
+import threading
+import time
+from hashlib import sha1
+from ..cache import RowCache
+from ..config import get_app_config
+from ..metrics import gauge
+
+_digests = {}
+_digests_lock = threading.Lock()
+
+def file_digest(path):
+    """SHA1 of a file's contents, recomputed only when its size or mtime changes."""
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    with _digests_lock:
+        if key in _digests:
+            return _digests[key]
+
+    digest = sha1()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(2**20), b""):
+            digest.update(block)
+
+    with _digests_lock:
+        _digests[key] = digest.hexdigest()
+
+    return _digests[key]
+
+
+class DiskRowCache:
+    """SQLite backed row store shared by every process pointing at `path`.
+
+    The database runs in WAL mode so readers in other gunicorn workers are
+    not blocked by writes. Each thread keeps its own connection. Once more
+    than `max_rows` rows are stored, the oldest written are deleted until
+    a tenth of the room is free again; 0 keeps every row.
+
+    """
+    _query_size = 500
+
+    def __init__(self, path, max_rows=0):
+        self.path = path
+        self.max_rows = max_rows
+        self._written = 0
+        self._written_lock = threading.Lock()
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " namespace TEXT NOT NULL,"
+                " sequence TEXT NOT NULL,"
+                " value BLOB NOT NULL,"
+                " added REAL NOT NULL DEFAULT 0,"
+                " PRIMARY KEY (namespace, sequence)"
+                ") WITHOUT ROWID"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(results)")]
+            if "added" not in columns:
+                # Caches written before rows were timed count as oldest
+                conn.execute("ALTER TABLE results ADD COLUMN added REAL NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS results_added ON results (added)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+
+        return conn
+
+    def get_many(self, namespace, sequences):
+        found = {}
+        conn = self._connection()
+        for start in range(0, len(sequences), self._query_size):
+            chunk = sequences[start:start + self._query_size]
+            rows = conn.execute(
+                "SELECT sequence, value FROM results"
+                " WHERE namespace = ? AND sequence IN ({})".format(
+                    ",".join("?" * len(chunk))
+                ),
+                [namespace] + list(chunk)
+            )
+            found.update(rows)
+
+        return [found.get(seq) for seq in sequences]
+
+    def _trim(self, conn):
+        # Counting every row is slow on a large table, so only trim after
+        # writing about a hundredth of the limit
+        count = conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if count > self.max_rows:
+            conn.execute(
+                "DELETE FROM results WHERE (namespace, sequence) IN"
+                " (SELECT namespace, sequence FROM results ORDER BY added LIMIT ?)",
+                (count - self.max_rows + self.max_rows // 10,)
+            )
+
+    def put_many(self, namespace, sequences, rows):
+        added = time.time()
+        with self._connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                [(namespace, seq, row if isinstance(row, bytes) else row.tobytes(), added)
+                 for seq, row in zip(sequences, rows)]
+            )
+
+        if self.max_rows <= 0:
+            return
+
+        with self._written_lock:
+            self._written += len(sequences)
+            trim = self._written >= max(self.max_rows // 100, 1)
+            if trim:
+                self._written = 0
+        if trim:
+            with self._connection() as conn:
+                self._trim(conn)
+
+
+class ResultCache:
+    """Two tier cache of model outputs per sequence.
+
+    Lookups go to the in-memory LRU first and fall back to the optional
+    on-disk tier, promoting anything found there. Namespaces are derived
+    from the model files' contents and the backend running them, so
+    replacing a model's weights makes its old entries unreachable without
+    an explicit flush.
+
+    """
+    def __init__(self, memory=None, disk=None):
+        self.memory = memory
+        self.disk = disk
+        self.disk_hits = 0
+
+    def namespace(self, config_path, weight_path, pre_fingerprint, action, backend=""):
+        key = "\0".join([file_digest(config_path),
+                         file_digest(weight_path),
+                         pre_fingerprint,
+                         str(action),
+                         backend])
+        return sha1(key.encode()).hexdigest()
+
+    def get_many(self, namespace, sequences):
+        rows = [None] * len(sequences)
+        if self.memory is not None:
+            rows = self.memory.get_many(namespace, sequences)
+
+        if self.disk is not None:
+            miss_inds = [ind for ind, row in enumerate(rows) if row is None]
+            if miss_inds:
+                misses = [sequences[ind] for ind in miss_inds]
+                disk_rows = self.disk.get_many(namespace, misses)
+                found = [(seq, row) for seq, row in zip(misses, disk_rows)
+                         if row is not None]
+                self.disk_hits += len(found)
+                if found and self.memory is not None:
+                    self.memory.put_many(namespace, *zip(*found))
+                for ind, row in zip(miss_inds, disk_rows):
+                    rows[ind] = row
+
+        return rows
+
+    def put_many(self, namespace, sequences, rows):
+        rows = [row.tobytes() for row in rows]
+        if self.memory is not None:
+            self.memory.put_many(namespace, sequences, rows)
+        if self.disk is not None:
+            self.disk.put_many(namespace, sequences, rows)
+
+    def stats(self):
+        stats = self.memory.stats() if self.memory is not None else {}
+        stats["disk_hits"] = self.disk_hits
+        return stats
+
+
+_cache = None
+_cache_checked = False
+_cache_lock = threading.Lock()
+
+def get_result_cache():
+    global _cache, _cache_checked
+    with _cache_lock:
+        if not _cache_checked:
+            _cache_checked = True
+            app_config = get_app_config()
+            memory, disk = None, None
+            if app_config["result_cache_entries"] > 0:
+                memory = RowCache(
+                    max_entries=app_config["result_cache_entries"],
+                    max_bytes=int(app_config["result_cache_mb"] * 2**20)
+                )
+            if app_config["result_cache_path"]:
+                disk = DiskRowCache(app_config["result_cache_path"],
+                                    app_config["result_cache_disk_rows"])
+            if memory is not None or disk is not None:
+                _cache = ResultCache(memory, disk)
+
+    return _cache
+
+def _cache_stat(name):
+    return lambda: _cache.stats().get(name) if _cache is not None else None
+
+gauge("deeppep_result_cache_hit_rate", "Share of in memory result cache lookups found",
+      fn=_cache_stat("hit_rate"))
+gauge("deeppep_result_cache_entries", "Rows held in the in memory result cache",
+      fn=_cache_stat("entries"))
+gauge("deeppep_result_cache_bytes", "Bytes held in the in memory result cache",
+      fn=_cache_stat("bytes"))
+gauge("deeppep_result_cache_disk_hits", "Rows found in the on disk result cache",
+      fn=_cache_stat("disk_hits"))
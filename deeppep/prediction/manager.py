@@ -1,19 +1,69 @@
+import logging
 import os
+import time
+import numpy as np
+
+# Cold start time is dominated by this import, record it for warm-up logs
+_import_start = time.perf_counter()
 import tensorflow as tf
-from tensorflow.keras import models, backend
+from tensorflow.keras import models, layers
+TF_IMPORT_SECONDS = time.perf_counter() - _import_start
+
 from fastapi import HTTPException
+from ..config import get_app_config
+from .registry import get_registry
+from .batching import get_batcher
+from ..metrics import histogram, timed, SIZE_BUCKETS
+from ..admission import check_deadline
+from ..types import Backend
+from .backends import FunctionBackend, TFLiteBackend, load_tflite
 
 tf.get_logger().setLevel('ERROR')
+logger = logging.getLogger("uvicorn.error")
+
+PREDICT_ROWS = histogram("deeppep_predict_rows",
+                         "Rows per call to a model's predict or encode",
+                         buckets=SIZE_BUCKETS,
+                         labels=("model", "action"))
+
+_app_config = get_app_config()
+tf.config.threading.set_intra_op_parallelism_threads(_app_config["tf_intra_threads"])
+tf.config.threading.set_inter_op_parallelism_threads(_app_config["tf_inter_threads"])
+
+def _variable_length_model(model):
+    # Rebuild the same layers behind an input with no fixed sequence length
+    inputs = tf.keras.Input(shape=(None,), dtype=model.inputs[0].dtype)
+    outputs = inputs
+    for layer in model.layers:
+        outputs = layer(outputs)
+
+    return tf.keras.Model(inputs, outputs)
+
+def _feature_extractor(model, layer_ind):
+    # Same layers and weights, stopping at an inner layer's activations
+    return tf.keras.Model(model.inputs, model.layers[layer_ind].output)
+
+def _trimmed_lengths(input):
+    # Position after the last non-padding token of each row
+    nonzero = input != 0
+    last = input.shape[1] - np.argmax(nonzero[:, ::-1], axis=1)
+    return np.where(nonzero.any(axis=1), last, 0)
 
 class PredictionManager:
-    def __init__(self, model_name, config_path, weight_path):
+    def __init__(self, model_name, config_path, weight_path,
+                 backend=Backend.keras, quantize=False, seq_len=0):
         self.model_name = model_name
+        self.load_timings = {}
         self.config_path = self._check_path(config_path)
         self.weight_path = self._check_path(weight_path)
-        self.model = self._load_model()
+        self.loaded = get_registry().get(self._registry_key(),
+                                         self._load_model)
+        self.model = self.loaded.model
 
-    def __del__(self):
-        backend.clear_session()
+        self.backend = Backend(backend)
+        self.quantize = quantize
+        self.seq_len = seq_len
+        self.runner = self._get_runner()
 
     def _path_not_found_message(self, path):
         message = " ".join([
@@ -31,6 +81,11 @@ class PredictionManager:
                                 )
         return path
 
+    def _registry_key(self):
+        return (self.config_path,
+                self.weight_path,
+                os.path.getmtime(self.weight_path))
+
     def _model_not_loaded_message(self):
         message = " ".join([
             "MODEL LOADING ERROR:",
@@ -41,10 +96,29 @@ class PredictionManager:
 
 
     def _load_model(self):
+        # Weights overwritten in place get a new key, drop the stale build
+        get_registry().evict_paths(self.config_path, self.weight_path)
+        with timed("model_load", self.model_name):
+            return self._build_model()
+
+    def _build_model(self):
         try:
+            start = time.perf_counter()
             with open(self.config_path, "r") as config:
                 model = models.model_from_json(config.read())
+            built = time.perf_counter()
             model.load_weights(self.weight_path)
+            weighted = time.perf_counter()
+            model.make_predict_function()
+
+            self.load_timings = {"build" : built - start,
+                                 "weights" : weighted - built,
+                                 "compile" : time.perf_counter() - weighted}
+            logger.info("Loaded model %s: build %.3fs, weights %.3fs, compile %.3fs",
+                        self.model_name,
+                        self.load_timings["build"],
+                        self.load_timings["weights"],
+                        self.load_timings["compile"])
 
             return model
 
@@ -52,13 +126,151 @@ class PredictionManager:
             raise HTTPException(status_code=500,
                                 detail=self._model_not_loaded_message())
 
-    def predict(self, input):
+    def _backend_not_loaded_message(self, error):
+        message = " ".join([
+            "MODEL LOADING ERROR:",
+            "Could not prepare the {} backend of model {}: {}"
+            ]).format(self.backend.value, self.model_name, error)
+
+        return message
+
+    def _build_function(self, model):
+        with timed("backend_load", self.model_name):
+            return FunctionBackend(model, self.seq_len)
+
+    def _build_tflite(self, model):
+        with timed("backend_load", self.model_name):
+            content = load_tflite(model,
+                                  (self.config_path, self.weight_path),
+                                  seq_len=self.seq_len,
+                                  quantize=self.quantize)
+            return TFLiteBackend(content, threads=_app_config["tf_intra_threads"])
+
+    def _get_runner(self):
+        # Compiled backends are built from the resident Keras model and
+        # kept beside it, so they are dropped along with it
+        if self.backend == Backend.keras:
+            return None
+
+        builder = (self._build_function if self.backend == Backend.function
+                   else self._build_tflite)
+        name = "{}:{}:{}".format(self.backend.value, self.seq_len, self.quantize)
+        try:
+            return self.loaded.derived(name, builder)
+
+        except Exception as err:
+            logger.exception("Could not build backend for model %s", self.model_name)
+            raise HTTPException(status_code=500,
+                                detail=self._backend_not_loaded_message(err))
+
+    def _supports_bucketing(self, input):
+        first_layer = self.model.layers[0]
+        return (input.ndim == 2
+                and isinstance(first_layer, layers.Embedding)
+                and first_layer.mask_zero)
+
+    def _predict_bucketed(self, input, width):
+        # Masked trailing steps leave the GRU state untouched, so trimming
+        # them changes only the work done, not the result
+        lengths = _trimmed_lengths(input)
+        buckets = np.clip(-(-lengths // width) * width, width, input.shape[1])
+        model = self.loaded.derived("variable_length", _variable_length_model)
+
+        output = None
+        for bucket in np.unique(buckets):
+            rows = np.flatnonzero(buckets == bucket)
+            bucket_output = model.predict(input[rows, :bucket])
+            if output is None:
+                output = np.empty(shape=(input.shape[0],) + bucket_output.shape[1:],
+                                  dtype=bucket_output.dtype)
+            output[rows] = bucket_output
+
+        return output
+
+    def _predict(self, input):
+        if self.runner is not None:
+            return self.runner.predict(input)
+
+        width = _app_config["bucket_width"]
+        if width > 0 and input.shape[0] > 0 and self._supports_bucketing(input):
+            return self._predict_bucketed(input, width)
+
         output = self.model.predict(input)
         return output
 
-    def encode(self, input):
-        output = input
-        for l in self.model.layers[:-1]:
-            output = l(output)
+    def _empty_output(self, fn, input):
+        # Keras refuses empty input, so run one padding row for the width
+        return fn(np.zeros((1,) + input.shape[1:], dtype=input.dtype))[:0]
+
+    def predict(self, input):
+        if input.shape[0] == 0:
+            return self._empty_output(self.predict, input)
+
+        check_deadline(self.model_name)
+        PREDICT_ROWS.observe(input.shape[0], model=self.model_name, action="predict")
+        batcher = get_batcher(self.model_name, self.loaded)
+        with timed("predict", self.model_name):
+            if batcher is None:
+                return self._predict(input)
+
+            return batcher.submit(input, self._predict)
+
+    def _unknown_layer_message(self, layer):
+        message = " ".join([
+            "ENCODING ERROR:",
+            "Model {} has no layer {}.",
+            "Give a layer index or one of the names: {}"
+            ]).format(self.model_name, layer,
+                      ", ".join(l.name for l in self.model.layers))
+
+        return message
+
+    def _layer_index(self, layer):
+        n_layers = len(self.model.layers)
+        if layer is None:
+            return n_layers - 2
+
+        names = [l.name for l in self.model.layers]
+        if layer in names:
+            return names.index(layer)
+
+        try:
+            layer_ind = int(layer)
+        except ValueError:
+            layer_ind = n_layers
+        if not -n_layers <= layer_ind < n_layers:
+            raise HTTPException(status_code=400,
+                                detail=self._unknown_layer_message(layer))
+
+        return layer_ind % n_layers
+
+    def _encoder(self, layer):
+        layer_ind = self._layer_index(layer)
+        batch_size = _app_config["encode_batch_size"]
+
+        def build(model):
+            with timed("backend_load", self.model_name):
+                return FunctionBackend(_feature_extractor(model, layer_ind),
+                                       self.seq_len, batch_size)
+
+        return self.loaded.derived("encoder:{}:{}:{}".format(layer_ind,
+                                                              self.seq_len,
+                                                              batch_size),
+                                   build)
+
+    def encode(self, input, layer=None):
+        """Activations of a layer, by default the one before the output.
+
+        `layer` is a layer name or index. Activations with more than one
+        dimension per row, such as a sequence of embeddings, are flattened.
+        """
+        if input.shape[0] == 0:
+            return self._empty_output(lambda input: self.encode(input, layer), input)
+
+        check_deadline(self.model_name)
+        encoder = self._encoder(layer)
+        PREDICT_ROWS.observe(input.shape[0], model=self.model_name, action="encode")
+        with timed("encode", self.model_name):
+            output = encoder.predict(input)
 
-        return output.numpy()
+            return output.reshape(output.shape[0], -1)
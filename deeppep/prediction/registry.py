@@ -0,0 +1,169 @@
+import threading
+import time
+from collections import OrderedDict
+from ..config import get_app_config
+from ..metrics import gauge
+
+
+def _model_nbytes(model):
+    nbytes = 0
+    for weight in getattr(model, "weights", []):
+        count = 1
+        for dim in weight.shape:
+            count *= int(dim)
+        nbytes += count * weight.dtype.size
+
+    return nbytes
+
+
+class LoadedModel:
+    def __init__(self, key, model, load_time):
+        self.key = key
+        self.model = model
+        self.nbytes = _model_nbytes(model)
+        self.load_time = load_time
+        self._derived = {}
+        self._lock = threading.Lock()
+
+    def derived(self, name, builder):
+        """Build and keep a companion object, such as a sub-model, once per model."""
+        with self._lock:
+            if name not in self._derived:
+                self._derived[name] = builder(self.model)
+
+            return self._derived[name]
+
+
+class ModelRegistry:
+    """Process wide store of built models shared across requests.
+
+    Models are built once per key by a caller supplied loader and kept
+    resident until the sum of their parameter sizes exceeds `budget_bytes`,
+    at which point the least recently used models are dropped. Dropping a
+    model only removes the registry's reference, so requests still holding
+    it keep working and the memory is reclaimed once they finish.
+
+    """
+    def __init__(self, budget_bytes=0):
+        self.budget_bytes = budget_bytes
+        self._models = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_time = 0.
+
+    def _lookup(self, key):
+        loaded = self._models.get(key)
+        if loaded is not None:
+            self._models.move_to_end(key)
+            self.hits += 1
+
+        return loaded
+
+    def _enforce_budget(self):
+        if self.budget_bytes <= 0:
+            return
+
+        total = sum(loaded.nbytes for loaded in self._models.values())
+        while total > self.budget_bytes and len(self._models) > 1:
+            _, evicted = self._models.popitem(last=False)
+            total -= evicted.nbytes
+            self.evictions += 1
+
+    def get(self, key, loader):
+        with self._lock:
+            loaded = self._lookup(key)
+            if loaded is not None:
+                return loaded
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                loaded = self._lookup(key)
+                if loaded is not None:
+                    return loaded
+
+            start = time.perf_counter()
+            try:
+                model = loader()
+            except BaseException:
+                with self._lock:
+                    self._loading.pop(key, None)
+                raise
+            loaded = LoadedModel(key, model, time.perf_counter() - start)
+
+            with self._lock:
+                self._models[key] = loaded
+                self._loading.pop(key, None)
+                self.misses += 1
+                self.load_time += loaded.load_time
+                self._enforce_budget()
+
+        return loaded
+
+    def evict(self, key):
+        with self._lock:
+            if self._models.pop(key, None) is not None:
+                self.evictions += 1
+
+    def evict_paths(self, config_path, weight_path):
+        """Drop every loaded copy of a model's files, whatever their mtime."""
+        with self._lock:
+            for key in [key for key in self._models
+                        if key[:2] == (config_path, weight_path)]:
+                del self._models[key]
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self.evictions += len(self._models)
+            self._models.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "models": len(self._models),
+                "bytes": sum(loaded.nbytes for loaded in self._models.values()),
+                "budget_bytes": self.budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "load_time": self.load_time,
+            }
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            app_config = get_app_config()
+            _registry = ModelRegistry(
+                budget_bytes=int(app_config["model_cache_mb"] * 2**20)
+            )
+
+    return _registry
+
+def _registry_stat(name):
+    return lambda: _registry.stats()[name] if _registry is not None else None
+
+def _registry_hit_rate():
+    if _registry is None:
+        return None
+    stats = _registry.stats()
+    lookups = stats["hits"] + stats["misses"]
+    return stats["hits"] / lookups if lookups else 0.
+
+gauge("deeppep_models_loaded", "Models held in memory",
+      fn=_registry_stat("models"))
+gauge("deeppep_models_bytes", "Bytes of weights held by loaded models",
+      fn=_registry_stat("bytes"))
+gauge("deeppep_model_registry_hit_rate", "Share of model lookups served from memory",
+      fn=_registry_hit_rate)
+gauge("deeppep_model_load_seconds", "Time spent loading models so far",
+      fn=_registry_stat("load_time"))
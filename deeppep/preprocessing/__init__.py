@@ -1 +1,2 @@
 from .manager import PreprocessingManager
+from .cache import EncodingCache, get_encoding_cache
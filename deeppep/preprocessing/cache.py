@@ -0,0 +1,37 @@
+import threading
+from ..cache import RowCache
+from ..config import get_app_config
+from ..metrics import gauge
+
+
+class EncodingCache(RowCache):
+    """Row cache of int32 encodings keyed by preprocessing fingerprint."""
+
+
+_cache = None
+_cache_checked = False
+_cache_lock = threading.Lock()
+
+def get_encoding_cache():
+    global _cache, _cache_checked
+    with _cache_lock:
+        if not _cache_checked:
+            _cache_checked = True
+            app_config = get_app_config()
+            if app_config["encoding_cache_entries"] > 0:
+                _cache = EncodingCache(
+                    max_entries=app_config["encoding_cache_entries"],
+                    max_bytes=int(app_config["encoding_cache_mb"] * 2**20)
+                )
+
+    return _cache
+
+def _cache_stat(name):
+    return lambda: _cache.stats()[name] if _cache is not None else None
+
+gauge("deeppep_encoding_cache_hit_rate", "Share of encoding cache lookups found",
+      fn=_cache_stat("hit_rate"))
+gauge("deeppep_encoding_cache_entries", "Sequences held in the encoding cache",
+      fn=_cache_stat("entries"))
+gauge("deeppep_encoding_cache_bytes", "Bytes held in the encoding cache",
+      fn=_cache_stat("bytes"))
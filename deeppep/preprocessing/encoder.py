@@ -5,6 +5,12 @@ from itertools import chain
 from sklearn.base import TransformerMixin
 
 
+class _TokenLookup(dict):
+    """Vocabulary copy which maps unknown tokens to -1 instead of raising."""
+    def __missing__(self, key):
+        return -1
+
+
 class SequenceEncoder(TransformerMixin):
     """Transformer to parse and encode biological sequences.
 
@@ -45,6 +51,7 @@ class SequenceEncoder(TransformerMixin):
         self.seq_len = seq_len
         self.one_hot = one_hot
         self.oov_warn = oov_warn
+        self._lookup = _TokenLookup(self.vocab)
 
     # START: Fit functions
 
@@ -105,24 +112,56 @@ class SequenceEncoder(TransformerMixin):
         X = np.atleast_1d(X)
         token_count = self._unique_tokens(X)
         self.vocab.update(self._tokens_to_vocab(token_count))
+        self._lookup = _TokenLookup(self.vocab)
 
         return self
 
     # START: Transform functions
 
     def _warn_oov(self):
-        """Warn if token is not found in vocabulary and self.oov_warn==True."""
+        """Warn if tokens are not found in vocabulary and self.oov_warn==True."""
         if self.oov_warn:
             warnings.warn("Token not found in vocabulary", RuntimeWarning)
 
-    def _get_seq_len(self, input):
+    def _tokenize(self, input):
+        """Tokenize every sequence exactly once into a flat id buffer.
+
+        Each sequence is split with the user's regex and all tokens are
+        mapped to vocabulary ids in a single pass. Tokens missing from the
+        vocabulary are collected and given the padding id.
+
+        Args:
+            input (List[str]): Sequences to tokenize.
+
+        Returns:
+            ndarray(dtype=int32): Ids of all tokens, sequences concatenated.
+            ndarray(dtype=int64): Number of tokens in each sequence.
+            set: Tokens not found in the vocabulary.
+
+        """
+        token_lists = list(map(self.regex.findall, input))
+        lengths = np.fromiter(map(len, token_lists),
+                              dtype=np.int64, count=len(token_lists))
+        tokens = list(chain.from_iterable(token_lists))
+
+        ids = np.fromiter(map(self._lookup.__getitem__, tokens),
+                          dtype=np.int32, count=len(tokens))
+        oov_tokens = set()
+        oov_mask = ids < 0
+        if oov_mask.any():
+            oov_tokens = {tokens[ind] for ind in np.flatnonzero(oov_mask)}
+            ids[oov_mask] = 0
+
+        return ids, lengths, oov_tokens
+
+    def _get_seq_len(self, lengths):
         """Get length of final encoding sequences.
 
         The user specified length will be returned if available, otherwise
         the length of the longest sequence will be used.
 
         Args:
-            input (List[str]): Sequences to iterate through.
+            lengths (ndarray): Number of tokens in each sequence.
 
         Returns:
             int: Length of longest sequence or user specified length if available.
@@ -131,50 +170,50 @@ class SequenceEncoder(TransformerMixin):
         if self.seq_len > 0:
             seq_len = self.seq_len
         else:
-            seq_len = max(map(
-                lambda seq: len(self.regex.findall(seq)), input
-                ))
+            seq_len = int(lengths.max())
 
         return seq_len
 
     def _create_encoding(self, input):
         """Covert a list of strings into an int32 encoded sequence.
 
-        Sequences are iterated through and converted into an NxM matrix of int32. 
-        N is determined by the first dimension of X and M is determined by the 
-        results of self._get_seq_len. The user specified regex string is used 
-        to iterate through the sequences until M tokens are analyzed. 
-        Sequences shorter than M are extended by padding with 0.
+        Sequences are converted into an NxM matrix of int32. N is determined
+        by the first dimension of X and M is determined by the results of
+        self._get_seq_len. Token ids are gathered from the flat buffer made by
+        self._tokenize into the first M positions of each row with a single
+        masked assignment. Sequences shorter than M are extended by padding with 0.
 
         Args:
             input (List[str]): Tokenized sequences.
 
         Returns:
             ndarray(dtype=int32): Integer encoding of input sequences.
+            set: Tokens not found in the vocabulary.
 
         """
-        seq_len = self._get_seq_len(input)
-        out = np.zeros(shape=(input.shape[0], seq_len),
-                       dtype=np.int32)
+        ids, lengths, oov_tokens = self._tokenize(input)
+        seq_len = self._get_seq_len(lengths)
+
+        starts = np.cumsum(lengths) - lengths
+        positions = np.arange(seq_len)
+        mask = positions < lengths[:, None]
 
-        for seq_ind, seq in enumerate(input):
-            for match_ind, match in enumerate(self.regex.findall(seq)):
-                if match_ind == seq_len:
-                    break
+        out = np.zeros(shape=(len(input), seq_len),
+                       dtype=np.int32)
+        out[mask] = ids[(starts[:, None] + positions)[mask]]
 
-                try:
-                   out[seq_ind, match_ind] = self.vocab[match]
-                except KeyError:
-                    self._warn_oov()
+        if oov_tokens:
+            self._warn_oov()
 
-        return out
+        return out, oov_tokens
 
     def _encoding_to_one_hot(self, input):
         """Create a one hot encoding from a pre-made integer encoding.
 
         An integer encoding matrix of shape NxM is converted to a one hot
         matrix of shape NxMxV. Values in the integer encoding are decreased
-        by 1 and padding vectors are left entirely as 0.
+        by 1 and padding vectors are left entirely as 0. All non-padding
+        positions are set with a single fancy indexed assignment.
 
         Args:
             input (ndarray(dtype=int32)):
@@ -186,15 +225,59 @@ class SequenceEncoder(TransformerMixin):
         vocab_size = max(self.vocab.values())
         out = np.zeros(shape=(input.shape[0],
                               input.shape[1],
-                              vocab_size + 1),
+                              vocab_size),
                         dtype=np.float32)
-        for row_ind, row in enumerate(input):
-            out[row_ind][np.arange(row.shape[0]), row] = 1.
 
-        out = out[:, :, 1:]
+        rows, cols = np.nonzero(input)
+        out[rows, cols, input[rows, cols] - 1] = 1.
 
         return out
 
+    def finalize(self, input):
+        """Convert an integer encoding into the user specified output type.
+
+        Args:
+            input (ndarray(dtype=int32)): Integer encoding from `integer_transform_with_oov`.
+
+        Returns:
+            ndarray: Output encoding, type determined by `self.one_hot`.
+
+        """
+        if not self.one_hot:
+            return input
+
+        return self._encoding_to_one_hot(input)
+
+    def integer_transform_with_oov(self, X):
+        """Integer encode sequences regardless of the `one_hot` setting.
+
+        Args:
+            X (List[str]): Input sequences to transform.
+
+        Returns:
+            ndarray(dtype=int32): Integer encoding of input sequences.
+            set: Tokens not found in the vocabulary.
+
+        """
+        X = [X] if isinstance(X, str) else list(X)
+        return self._create_encoding(X)
+
+    def transform_with_oov(self, X):
+        """Transform sequences and report tokens missing from the vocabulary.
+
+        Args:
+            X (List[str]): Input sequences to transform.
+
+        Returns:
+            ndarray: Output encoding, type determined by `self.one_hot`.
+            set: Tokens not found in the vocabulary.
+
+        """
+        out, oov_tokens = self.integer_transform_with_oov(X)
+        out = self.finalize(out)
+
+        return out, oov_tokens
+
     def transform(self, X, **kwargs):
         """Transform a list of sequences into user specified encodings.
 
@@ -206,10 +289,6 @@ class SequenceEncoder(TransformerMixin):
             ndarray: Output encoding, type determined by `self.one_hot`.
 
         """
-        X = np.atleast_1d(X)
-        out = self._create_encoding(X)
-        if self.one_hot:
-            out = self._encoding_to_one_hot(out)
-
+        out, _ = self.transform_with_oov(X)
         return out
 
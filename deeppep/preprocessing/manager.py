@@ -1,7 +1,17 @@
-import re
-from itertools import chain
+import numpy as np
+from functools import lru_cache
 from fastapi import HTTPException
+from ..types import fingerprint
 from .encoder import SequenceEncoder
+from .cache import get_encoding_cache
+
+@lru_cache(maxsize=64)
+def _cached_encoder(pattern, vocab_items, seq_len=0, one_hot=False):
+    return SequenceEncoder(pattern, dict(vocab_items),
+                           seq_len=seq_len, one_hot=one_hot, oov_warn=False)
+
+def get_encoder(pattern, vocab, **kwargs):
+    return _cached_encoder(pattern, tuple(sorted(vocab.items())), **kwargs)
 
 class PreprocessingManager:
     def __init__(self, pattern, vocab, max_vocab_dim, **kwargs):
@@ -11,7 +21,11 @@ class PreprocessingManager:
         self.vocab = vocab
         self._check_vocab_dim()
         
-        self.encoder = SequenceEncoder(pattern, self.vocab, **kwargs)
+        self.encoder = get_encoder(pattern, self.vocab, **kwargs)
+        self.fingerprint = fingerprint(pattern=pattern,
+                                       vocab=self.vocab,
+                                       seq_len=self.encoder.seq_len,
+                                       one_hot=self.encoder.one_hot)
 
     def _vocab_dim_message(self, cur_vocab_dim, vocab_dim):
         message = " ".join([
@@ -43,20 +57,54 @@ class PreprocessingManager:
 
         return message
 
-    def _check_consistency(self, sequences):
-        oov_set = set(chain.from_iterable(
-            [re.findall(self.pattern, seq) for seq in sequences]
-            ))
-        oov_set.difference_update(self.vocab.keys())
-
+    def _check_consistency(self, oov_set):
         if oov_set:
             raise HTTPException(status_code = 400,
                                 detail = self._unknown_tokens_message(oov_set)
                                 )
 
-    def preprocess(self, input):
-        self._check_consistency(input)
-        output = self.encoder.transform(input)
+    def _integer_encode(self, input):
+        cache = get_encoding_cache()
+        seq_len = self.encoder.seq_len
+        if cache is None or seq_len <= 0:
+            return self.encoder.integer_transform_with_oov(input)
+
+        rows = cache.get_many(self.fingerprint, input)
+        miss_inds = [ind for ind, row in enumerate(rows) if row is None]
+        if not miss_inds:
+            output = np.frombuffer(b"".join(rows), dtype=np.int32)
+            return output.reshape(len(rows), seq_len).copy(), set()
+
+        output = np.zeros(shape=(len(rows), seq_len), dtype=np.int32)
+        hit_inds = [ind for ind, row in enumerate(rows) if row is not None]
+        if hit_inds:
+            hits = np.frombuffer(b"".join(rows[ind] for ind in hit_inds),
+                                 dtype=np.int32)
+            output[hit_inds] = hits.reshape(len(hit_inds), seq_len)
+
+        misses = [input[ind] for ind in miss_inds]
+        miss_output, oov_set = self.encoder.integer_transform_with_oov(misses)
+        output[miss_inds] = miss_output
+
+        # Requests with unknown tokens are rejected, so never cache their rows
+        if not oov_set:
+            cache.put_many(self.fingerprint, misses, miss_output)
+
+        return output, oov_set
+
+    def integer_encode(self, input):
+        output, oov_set = self._integer_encode(input)
+        self._check_consistency(oov_set)
 
         return output
+
+    def finalize_chunks(self, output, chunk_size):
+        return (self.encoder.finalize(output[start:start + chunk_size])
+                for start in range(0, output.shape[0], chunk_size))
+
+    def preprocess(self, input):
+        return self.encoder.finalize(self.integer_encode(input))
+
+    def preprocess_chunks(self, input, chunk_size):
+        return self.finalize_chunks(self.integer_encode(input), chunk_size)
     
@@ -0,0 +1,102 @@
+import logging
+import threading
+from fastapi import HTTPException
+from .config import get_app_config, get_spec_index, newest_version
+from .metrics import counter
+from .versions import get_versions, pinned_name
+from .warmup import warm_model, format_timings
+
+logger = logging.getLogger("uvicorn.error")
+
+ROLLOUTS = counter("deeppep_model_rollouts_total",
+                   "New model versions tried for rollout",
+                   labels=("model", "outcome"))
+
+
+class Rollout:
+    """Moves models to new versions appearing on disk without downtime.
+
+    Every `interval` seconds the spec index is checked for models in use
+    whose newest version is not the active one. The new version is loaded
+    next to the active one and run once on a synthetic batch, then swapped
+    in for unpinned requests. Requests already running finish on the
+    version they started with. A version that fails to warm up is not
+    retried until its spec is reloaded.
+
+    """
+    def __init__(self, interval, versions=None):
+        self.interval = interval
+        self.versions = get_versions() if versions is None else versions
+        self.failed = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self.versions.managed = True
+            self._thread = threading.Thread(target=self.run,
+                                            name="deeppep-rollout",
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Could not check for new model versions")
+
+    def check(self):
+        index = get_spec_index()
+        for model_name in sorted(index.get()):
+            if model_name not in self.versions.active:
+                # Not used yet, the first request loads the newest version
+                continue
+
+            versions = index.versions(model_name)
+            version = newest_version(versions)
+            spec = versions[version]
+            if (version == self.versions.active[model_name]
+                    or self.failed.get((model_name, version)) is spec):
+                continue
+
+            self.roll_out(model_name, version, spec)
+
+    def roll_out(self, model_name, version, spec):
+        previous = self.versions.active.get(model_name)
+        self.versions.reserve(model_name, version, spec)
+        try:
+            timings = warm_model(pinned_name(model_name, version))
+
+        except Exception as err:
+            self.versions.release(model_name, version)
+            self.failed[(model_name, version)] = spec
+            ROLLOUTS.inc(model=model_name, outcome="failed")
+            detail = err.detail if isinstance(err, HTTPException) else str(err)
+            logger.warning("Could not roll out model %s version %s, keeping %s: %s",
+                           model_name, version, previous, detail)
+            return False
+
+        self.versions.swap(model_name, version)
+        ROLLOUTS.inc(model=model_name, outcome="swapped")
+        logger.info("Rolled out model %s version %s in place of %s: %s",
+                    model_name, version, previous, format_timings(timings))
+        return True
+
+
+_rollout = None
+_rollout_lock = threading.Lock()
+
+def get_rollout():
+    global _rollout
+    with _rollout_lock:
+        if _rollout is None:
+            # Checking more often than the index refreshes finds nothing new
+            _rollout = Rollout(max(get_app_config()["spec_refresh"], 1.))
+
+    return _rollout
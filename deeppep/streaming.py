@@ -0,0 +1,165 @@
+import json
+import time
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from .admission import admit
+from .config import get_app_config
+from .executor import run_in_executor
+from .manager import PipelineManager
+from .types import Peptide, UserConfig
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# Longest line accepted, far beyond any peptide record
+MAX_LINE_BYTES = 2**16
+
+class InterleavedStreamingResponse(StreamingResponse):
+    """Streaming response which leaves the ASGI receive channel alone.
+
+    Results are sent while the request body is still being read by the
+    body iterator, so the response must not consume receive messages,
+    for instance to listen for disconnects, or it would steal body chunks.
+    """
+    async def __call__(self, scope, receive, send):
+        await send({"type" : "http.response.start",
+                    "status" : self.status_code,
+                    "headers" : self.raw_headers})
+        async for chunk in self.body_iterator:
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode(self.charset)
+            await send({"type" : "http.response.body",
+                        "body" : chunk,
+                        "more_body" : True})
+
+        await send({"type" : "http.response.body",
+                    "body" : b"",
+                    "more_body" : False})
+
+def _bad_line_message(line_number, error):
+    message = " ".join([
+        "STREAM ERROR:",
+        "Could not parse line {}: {}"
+        ]).format(line_number, error)
+
+    return message
+
+def _long_line_message(line_number):
+    message = " ".join([
+        "STREAM ERROR:",
+        "Line {} is longer than {} bytes.",
+        "Separate records with newlines."
+        ]).format(line_number, MAX_LINE_BYTES)
+
+    return message
+
+def _decode_line(line, line_number):
+    try:
+        return line.decode()
+    except UnicodeDecodeError as err:
+        raise HTTPException(status_code = 400,
+                            detail = _bad_line_message(line_number, err))
+
+async def iter_lines(byte_stream):
+    """Non-blank lines of a byte stream with their line numbers.
+
+    Raises 400 for lines which are not UTF-8 and 413 for lines over
+    MAX_LINE_BYTES, so a body without newlines is never held whole.
+    """
+    buffer, line_number = b"", 0
+    async for block in byte_stream:
+        buffer += block
+        lines = buffer.split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            line_number += 1
+            line = line.strip()
+            if len(line) > MAX_LINE_BYTES:
+                raise HTTPException(status_code = 413,
+                                    detail = _long_line_message(line_number))
+            if line:
+                yield line_number, _decode_line(line, line_number)
+
+        if len(buffer) > MAX_LINE_BYTES:
+            raise HTTPException(status_code = 413,
+                                detail = _long_line_message(line_number + 1))
+
+    buffer = buffer.strip()
+    if buffer:
+        yield line_number + 1, _decode_line(buffer, line_number + 1)
+
+def parse_line(line, line_number):
+    """Accept a JSON object, a JSON string or a bare sequence per line."""
+    try:
+        record = json.loads(line) if line[0] in "{\"" else line
+        if isinstance(record, str):
+            record = {"sequence" : record}
+
+        return record
+
+    except ValueError as err:
+        raise HTTPException(status_code = 400,
+                            detail = _bad_line_message(line_number, err))
+
+async def iter_chunks(records, chunk_size):
+    chunk = []
+    async for line_number, record in records:
+        try:
+            chunk.append(Peptide(**record))
+        except (TypeError, ValidationError) as err:
+            raise HTTPException(status_code = 400,
+                                detail = _bad_line_message(line_number, err))
+
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+def _error_line(err):
+    return json.dumps({"error" : {"status_code" : err.status_code,
+                                  "detail" : err.detail}}) + "\n"
+
+async def stream_pipeline(model_name, action, byte_stream):
+    lines = iter_lines(byte_stream)
+    try:
+        first_number, first_line = await lines.__anext__()
+        first = parse_line(first_line, first_number)
+    except StopAsyncIteration:
+        first = None
+
+    # An optional leading {"config": {...}} line patches the model defaults
+    user_config = None
+    if isinstance(first, dict) and "config" in first and "sequence" not in first:
+        try:
+            user_config = UserConfig(**first["config"])
+        except (TypeError, ValidationError) as err:
+            raise HTTPException(status_code = 400,
+                                detail = _bad_line_message(first_number, err))
+        first = None
+
+    pipeline = PipelineManager(model_name, user_config)
+
+    async def records():
+        if first is not None:
+            yield first_number, first
+        async for line_number, line in lines:
+            yield line_number, parse_line(line, line_number)
+
+    async def body():
+        app_config = get_app_config()
+        chunk_size = app_config["stream_chunk_size"]
+        if app_config["max_request_rows"] > 0:
+            chunk_size = min(chunk_size, app_config["max_request_rows"])
+        try:
+            async for chunk in iter_chunks(records(), chunk_size):
+                # Each chunk takes its turn in admission like a request
+                async with admit(model_name, len(chunk), start=time.time()):
+                    output = await run_in_executor(pipeline.run, chunk, action)
+                yield "".join(json.dumps(row) + "\n" for row in output)
+
+        except HTTPException as err:
+            # Headers are already sent, so report failures in band
+            yield _error_line(err)
+
+    return InterleavedStreamingResponse(body(), media_type=NDJSON_MEDIA_TYPE)
@@ -1,4 +1,6 @@
 from enum import Enum
+from json import dumps
+from hashlib import sha1
 from typing import List, Optional
 from pydantic import BaseModel
 
@@ -45,10 +47,31 @@ class PeptideProperty(str, Enum):
     mobility = "mobility"
     other = "other"
 
+class Backend(str, Enum):
+    keras = "keras"
+    function = "function"
+    tflite = "tflite"
+
 class Action(str, Enum):
     predict = "predict"
     encode = "encode"
 
+class OutputDType(str, Enum):
+    float32 = "float32"
+    float16 = "float16"
+
+class InputFormat(str, Enum):
+    csv = "csv"
+    tsv = "tsv"
+    txt = "txt"
+    fasta = "fasta"
+
+class JobState(str, Enum):
+    queued = "queued"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
 class PreprocessingConfig(BaseModel):
     pattern       : Optional[str] = "[A-Zn][^A-Zn]*"
     vocab         : Optional[dict] = DEFAULT_VOCAB
@@ -65,6 +88,9 @@ class ModelSpec(BaseModel):
     output_labels  : Optional[List[str]] = None
     allow_encoding : Optional[bool] = False
     public         : Optional[bool] = False
+    backend        : Optional[Backend] = Backend.keras
+    quantize       : Optional[bool] = False
+    version        : Optional[str] = None
 
 ############
 # Requests #
@@ -86,6 +112,11 @@ class ModelInput(BaseModel):
     peptides : List[Peptide]
     config   : Optional[UserConfig] = None
 
+class MultiModelInput(BaseModel):
+    models   : List[str]
+    peptides : List[Peptide]
+    config   : Optional[UserConfig] = None
+
 class PeptideSet(BaseModel):
     sequences : List[str]
     charges   : Optional[List[int]] = []
@@ -101,6 +132,28 @@ class PredictionInput(BaseModel):
 class Prediction(BaseModel):
     values : List[List[float]]
 
+class ModelSummary(BaseModel):
+    model_name     : str
+    property       : str
+    output_labels  : Optional[List[str]] = None
+    allow_encoding : bool
+    seq_len        : int
+    vocab          : dict
+    version        : Optional[str] = None
+    versions       : List[str] = []
+
+class JobInfo(BaseModel):
+    job_id      : str
+    state       : JobState
+    models      : List[str]
+    action      : Action
+    rows        : int
+    chunks      : int
+    chunks_done : int
+    created     : float
+    updated     : float
+    error       : Optional[str] = None
+
 ########
 # Util #
 ########
@@ -108,11 +161,13 @@ class Prediction(BaseModel):
 def merge_configs(left, right):
     # Copy to maintain read only
     left_dict = left.dict()
-    right_dict = right.dict()
+    # Unset fields of a user config are None and must not override
+    right_dict = {key : value for key, value in right.dict().items()
+                  if value is not None}
 
     # Pop out vocab dict and copy
     merged_vocab = left_dict.pop("vocab").copy()
-    merged_vocab.update(right_dict.pop("vocab"))
+    merged_vocab.update(right_dict.pop("vocab", {}))
 
     # Create final merged config
     merged = left_dict
@@ -120,3 +175,14 @@ def merge_configs(left, right):
     merged["vocab"] = merged_vocab
 
     return PreprocessingConfig(**merged)
+
+def fingerprint(**fields):
+    # Stable across processes, unlike hash()
+    encoded = dumps(fields, sort_keys=True, default=str).encode()
+    return sha1(encoded).hexdigest()
+
+def config_fingerprint(config):
+    return fingerprint(pattern=config.pattern,
+                       vocab=config.vocab,
+                       seq_len=config.seq_len,
+                       one_hot=config.one_hot)
@@ -0,0 +1,162 @@
+import threading
+from collections import OrderedDict
+from fastapi import HTTPException
+from .config import get_spec_index, newest_version, split_model_name, version_key
+from .metrics import gauge
+from .prediction import get_registry
+
+# Versions of one model that may be loaded at once, the one serving and
+# the one being rolled out or pinned
+MAX_RESIDENT = 2
+
+# Versions may be None, for specs that do not declare one
+_UNSET = object()
+
+def pinned_name(model_name, version):
+    if version is None:
+        return model_name
+
+    return "{}@{}".format(model_name, version)
+
+def _version_missing_message(model_name, version, versions):
+    message = " ".join([
+        "Model Not Found:",
+        "The model, {}, has no version {}.",
+        "Available versions: {}"
+        ]).format(model_name, version,
+                  ", ".join(str(version) for version in versions))
+
+    return message
+
+def _version_busy_message(model_name, version, resident):
+    message = " ".join([
+        "VERSION UNAVAILABLE:",
+        "Version {} of model {} cannot be loaded while versions {} are in use.",
+        "Retry without a version, or after the rollout has finished."
+        ]).format(version, model_name,
+                  ", ".join(str(version) for version in resident))
+
+    return message
+
+
+class VersionTable:
+    """Which version of each model serves requests that do not pin one.
+
+    Unpinned requests go to the active version, the newest on disk the
+    first time a model is used. When `managed` is set a rollout moves the
+    active version forward once the new one is warm, otherwise each use
+    follows the newest version on disk. Callers pin a version with
+    "name@version".
+
+    At most `max_resident` versions of a model are kept loaded. A version
+    leaving the table is dropped from the model registry; requests still
+    running on it hold their own reference, so it is freed once they drain.
+
+    """
+    def __init__(self, max_resident=MAX_RESIDENT):
+        self.max_resident = max_resident
+        self.managed = False
+        self.active = {}
+        self._resident = {}
+        self._lock = threading.Lock()
+
+    def _evict(self, model_name, version):
+        spec = self._resident[model_name].pop(version)
+        get_registry().evict_paths(spec.config_path, spec.weight_path)
+
+    def _admit(self, model_name, version, spec, keep=()):
+        # Make room by dropping the versions loaded longest ago
+        resident = self._resident.setdefault(model_name, OrderedDict())
+        if version in resident:
+            resident[version] = spec
+            return
+        for old in list(resident):
+            if len(resident) < self.max_resident:
+                break
+            if old not in keep:
+                self._evict(model_name, old)
+        resident[version] = spec
+
+    def _activate(self, model_name, version, spec):
+        self._admit(model_name, version, spec)
+        self.active[model_name] = version
+
+    def resolve(self, model_name):
+        """Spec of the version a request runs on, or None for unknown models."""
+        name, pinned = split_model_name(model_name)
+        versions = get_spec_index().versions(name)
+        if not versions:
+            return None
+
+        with self._lock:
+            if pinned is None:
+                version = self.active.get(name, _UNSET)
+                if not self.managed or version not in versions:
+                    newest = newest_version(versions)
+                    if newest != version:
+                        self._activate(name, newest, versions[newest])
+                    version = newest
+                return versions[version]
+
+            if pinned not in versions:
+                raise HTTPException(status_code = 404,
+                                    detail = _version_missing_message(
+                                        name, pinned,
+                                        sorted((version for version in versions
+                                                if version is not None),
+                                               key=version_key)))
+
+            resident = self._resident.setdefault(name, OrderedDict())
+            if pinned not in resident:
+                if len(resident) >= self.max_resident:
+                    # Never drop the active version or a rollout in progress
+                    raise HTTPException(status_code = 409,
+                                        detail = _version_busy_message(name, pinned,
+                                                                       list(resident)))
+                resident[pinned] = versions[pinned]
+
+            return versions[pinned]
+
+    def reserve(self, model_name, version, spec):
+        """Make room to load `version` next to the active one."""
+        with self._lock:
+            self._admit(model_name, version, spec,
+                        keep=(self.active.get(model_name),))
+
+    def release(self, model_name, version):
+        with self._lock:
+            if (version != self.active.get(model_name)
+                    and version in self._resident.get(model_name, {})):
+                self._evict(model_name, version)
+
+    def swap(self, model_name, version):
+        """Point unpinned requests at `version` and return the version it replaced.
+
+        The replaced version stays loaded for callers pinning it until the
+        next rollout needs its slot.
+        """
+        with self._lock:
+            previous = self.active.get(model_name)
+            self.active[model_name] = version
+            return previous
+
+    def resident(self):
+        with self._lock:
+            return {model_name : list(resident)
+                    for model_name, resident in self._resident.items() if resident}
+
+
+_versions = None
+_versions_lock = threading.Lock()
+
+def get_versions():
+    global _versions
+    with _versions_lock:
+        if _versions is None:
+            _versions = VersionTable()
+
+    return _versions
+
+gauge("deeppep_resident_model_versions", "Model versions kept loaded",
+      fn=lambda: (sum(map(len, _versions.resident().values()))
+                  if _versions is not None else None))
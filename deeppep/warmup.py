@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+from fastapi import HTTPException
+from .config import get_app_config, get_model_info
+from .manager import PipelineManager
+from .preprocessing import PreprocessingManager
+from .prediction.manager import TF_IMPORT_SECONDS
+
+logger = logging.getLogger("uvicorn.error")
+
+# Peptide length used when a model does not fix one
+TYPICAL_LENGTH = 20
+
+def synthetic_sequences(vocab, seq_len, step):
+    """Sequences of in-vocabulary tokens, one per multiple of `step` in length.
+
+    Covering every length bucket makes each bucket's input shape get traced
+    during warm-up rather than on a live request.
+    """
+    tokens = [token for token, ind in sorted(vocab.items(), key=lambda item: item[1])
+              if ind > 0]
+    if seq_len <= 0:
+        # Inputs are padded per batch, so one typical length will do
+        lengths = [TYPICAL_LENGTH]
+    elif step <= 0:
+        lengths = [seq_len]
+    else:
+        lengths = sorted(set(range(step, seq_len, step)) | {seq_len})
+
+    return ["".join(tokens[ind % len(tokens)] for ind in range(length))
+            for length in lengths]
+
+
+def warm_model(model_name):
+    """Load a model and run it once, returning the time each step took."""
+    pipeline = PipelineManager(model_name)
+    spec, pre_config = pipeline.model_config, pipeline.pre_config
+
+    start = time.perf_counter()
+    pred_manager = pipeline.prediction_manager()
+    timings = dict(pred_manager.load_timings)
+    if not timings:
+        # Another thread or an earlier request loaded it already
+        timings["load"] = time.perf_counter() - start
+
+    step = get_app_config()["bucket_width"] or pre_config.seq_len
+    pre_manager = PreprocessingManager(**pre_config.dict())
+    batch = pre_manager.preprocess(
+        synthetic_sequences(pre_config.vocab, pre_config.seq_len, step)
+    )
+
+    start = time.perf_counter()
+    pred_manager.predict(batch)
+    timings["first_predict"] = time.perf_counter() - start
+
+    if spec.allow_encoding:
+        start = time.perf_counter()
+        pred_manager.encode(batch)
+        timings["first_encode"] = time.perf_counter() - start
+
+    return timings
+
+def format_timings(timings):
+    return ", ".join("{} {:.3f}s".format(phase, seconds)
+                     for phase, seconds in timings.items())
+
+
+class WarmUp:
+    """Loads and exercises models in the background when a worker starts.
+
+    Each model is built, given its weights and run once on a synthetic batch
+    so that the first real request does not pay for graph construction and
+    tracing. `ready` stays False until every model has been tried; models
+    which fail are reported but do not hold readiness back.
+
+    """
+    def __init__(self, model_names=None):
+        self.model_names = model_names
+        self.models = {}
+        self._done = threading.Event()
+        self._thread = None
+
+        if model_names is None:
+            self._done.set()
+
+    @property
+    def ready(self):
+        return self._done.is_set()
+
+    def start(self):
+        if self._thread is None and not self.ready:
+            self._thread = threading.Thread(target=self.run,
+                                            name="deeppep-warmup",
+                                            daemon=True)
+            self._thread.start()
+
+    def run(self):
+        start = time.perf_counter()
+        logger.info("TensorFlow import took %.3fs", TF_IMPORT_SECONDS)
+        for model_name in self.model_names:
+            try:
+                timings = warm_model(model_name)
+                self.models[model_name] = {"seconds" : timings}
+                logger.info("Warmed up model %s: %s", model_name,
+                            format_timings(timings))
+
+            except HTTPException as err:
+                self.models[model_name] = {"error" : err.detail}
+                logger.warning("Could not warm up model %s: %s", model_name, err.detail)
+
+            except Exception as err:
+                self.models[model_name] = {"error" : str(err)}
+                logger.exception("Could not warm up model %s", model_name)
+
+        self._done.set()
+        logger.info("Warm up finished in %.3fs", time.perf_counter() - start)
+
+    def status(self):
+        return {"ready" : self.ready,
+                "models" : dict(self.models)}
+
+
+def _preload_models():
+    preload = get_app_config()["preload_models"].strip()
+    if not preload:
+        return None
+    if preload == "*":
+        return sorted(get_model_info())
+
+    return [name.strip() for name in preload.split(",") if name.strip()]
+
+_warm_up = None
+_warm_up_lock = threading.Lock()
+
+def get_warm_up():
+    global _warm_up
+    with _warm_up_lock:
+        if _warm_up is None:
+            _warm_up = WarmUp(_preload_models())
+
+    return _warm_up
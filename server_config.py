@@ -1,3 +1,4 @@
+import gc
 import os
 
 proc_name = "DeepPepServer"
@@ -12,6 +13,15 @@ worker_connections = 1000
 timeout = 30
 keepalive = 2
 
+# Import the app, and with it TensorFlow, once in the master so workers
+# share those pages copy-on-write. Models are still built after the fork.
+preload_app = os.getenv("DEEPPEP_PRELOAD_APP", "0") == "1"
+
+def when_ready(server):
+    # Keep the collector from touching, and so copying, preloaded objects
+    if preload_app:
+        gc.freeze()
+
 model_dir = os.getenv("DEEPPEP_MODEL_DIR", "")
 raw_env = [
     "DEEPPEP_MODEL_DIR=" + model_dir,
@@ -27,6 +37,7 @@ print(
 {proc_name} config settings:
 PORT:            {port}
 WORKERS:         {workers}
+PRELOAD APP:     {preload_app}
 MODEL DIRECTORY: {model_dir}
 """.format(**locals())
 )